@@ -0,0 +1,179 @@
+"""
+Regenerate ImmunizationRecommendation resources for a whole patient population, e.g. after a CDC schedule change.
+
+Patient DOBs and immunization histories are fetched per chunk in the main process; building the resources is
+CPU-only and runs in a process pool. Results are streamed to an NDJSON/Parquet file or uploaded as one FHIR
+transaction bundle per chunk, with a bounded number of chunks in flight.
+
+    python batch_generate.py patients.csv --out recommendations.ndjson
+    python batch_generate.py patients.csv --upload --workers 8
+"""
+import argparse
+import csv
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from fhirpy import SyncFHIRClient
+
+import bulk_io
+import calendar_feed
+import recommendations
+import schedule_model
+import schedule_rules
+import settings
+
+CHUNK_SIZE = 100
+
+_worker_schedule = None
+
+
+def read_patients(path):
+    """
+    Yield (patient id, birth date or None) from a CSV with an `id` column and an optional `birthDate` column.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row.get("id"):
+                yield row["id"].strip(), (row.get("birthDate") or "").strip() or None
+
+
+def fetch_chunk_context(client, chunk):
+    """
+    Fill in missing birth dates and fetch the immunization histories for a chunk of patients,
+    using one search per resource type for the whole chunk.
+    """
+    patient_ids = [patient_id for patient_id, _ in chunk]
+    birth_dates = {patient_id: dob for patient_id, dob in chunk if dob}
+    missing = [patient_id for patient_id in patient_ids if patient_id not in birth_dates]
+    if missing:
+        patients = client.resources("Patient").search(_id=",".join(missing)).elements("id", "birthDate").limit(len(missing))
+        for patient in patients:
+            if patient.get("birthDate"):
+                birth_dates[patient["id"]] = patient["birthDate"]
+
+    immunizations = {}
+    search_set = client.resources("Immunization").search(
+        patient=",".join(f"Patient/{patient_id}" for patient_id in patient_ids)
+    ).elements("patient", "status", "vaccineCode", "occurrenceDateTime")
+    for immunization in search_set:
+        immunization = immunization.serialize()
+        patient_id = immunization.get("patient", {}).get("reference", "").split("/")[-1]
+        immunizations.setdefault(patient_id, []).append(immunization)
+
+    return [
+        (patient_id, birth_dates[patient_id], immunizations.get(patient_id, []))
+        for patient_id in patient_ids if patient_id in birth_dates
+    ]
+
+
+def init_worker(schedule_path):
+    global _worker_schedule
+    _worker_schedule = schedule_rules.load_schedule(schedule_path)
+
+
+def generate_chunk(patients):
+    """
+    Runs in a worker process: build the recommendation resources for a chunk of (id, dob, immunizations).
+    """
+    results = []
+    for patient_id, patient_dob, immunizations in patients:
+        history = recommendations.immunization_history(immunizations)
+        results.extend(recommendations.build_recommendations(_worker_schedule, patient_id, patient_dob, history))
+    return results
+
+
+def generate(client, patients_path, schedule_path, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield (patient ids, generated resources) chunk by chunk, in input order, keeping at most two chunks per worker
+    in flight.
+    """
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(schedule_path,)) as executor:
+        pending = deque()
+        for chunk in bulk_io.chunked(read_patients(patients_path), chunk_size):
+            patient_ids = [patient_id for patient_id, _ in chunk]
+            pending.append((patient_ids, executor.submit(generate_chunk, fetch_chunk_context(client, chunk))))
+            if len(pending) >= workers * 2:
+                patient_ids, future = pending.popleft()
+                yield patient_ids, future.result()
+        while pending:
+            patient_ids, future = pending.popleft()
+            yield patient_ids, future.result()
+
+
+def existing_recommendation_ids(client, patient_ids):
+    """
+    Ids of the CDC schedule recommendations already on the server for a chunk of patients, in one search.
+    """
+    search_set = client.resources("ImmunizationRecommendation").search(
+        patient=",".join(f"Patient/{patient_id}" for patient_id in patient_ids),
+        identifier=settings.CDC_GROUP_IDENTIFIER_VALUE,
+    ).elements("id")
+    return [recommendation["id"] for recommendation in search_set]
+
+
+def upload(client, chunks):
+    """
+    Replace the chunk's patients' CDC schedule recommendations: the previous ones are deleted in the same
+    transaction as the new ones are created, like the Practitioner page does for a single patient.
+    """
+    count = 0
+    for patient_ids, resources in chunks:
+        entries = [
+            {"request": {"method": "DELETE", "url": f"ImmunizationRecommendation/{recommendation_id}"}}
+            for recommendation_id in existing_recommendation_ids(client, patient_ids)
+        ]
+        entries += [
+            {"resource": resource, "request": {"method": "POST", "url": "ImmunizationRecommendation"}}
+            for resource in resources
+        ]
+        if not entries:
+            continue
+        bundle = {"resourceType": "Bundle", "type": "transaction", "entry": entries}
+        client.execute("", method="post", data=bundle)
+        count += len(resources)
+        republish_feeds(patient_ids, resources)
+    return count
+
+
+def republish_feeds(patient_ids, resources):
+    """
+    Regenerate the calendar feeds already published for the chunk's patients from their new recommendations.
+    """
+    by_patient = {patient_id: [] for patient_id in patient_ids}
+    for resource in resources:
+        by_patient[resource["patient"]["reference"].split("/")[-1]].append(resource)
+    for patient_id, patient_resources in by_patient.items():
+        calendar_feed.republish_feed(patient_id, schedule_model.ScheduleModel(patient_resources))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate ImmunizationRecommendation resources for many patients in parallel.")
+    parser.add_argument("patients", help="CSV file with an `id` column and an optional `birthDate` column")
+    parser.add_argument("--out", help="NDJSON (.ndjson) or Parquet (.parquet) output file")
+    parser.add_argument("--upload", action="store_true", help="Upload to the FHIR server as transaction bundles")
+    parser.add_argument("--schedule", default=schedule_rules.DEFAULT_SCHEDULE_PATH)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--fhir-url", default=settings.FHIR_BASE_URL)
+    args = parser.parse_args()
+
+    if bool(args.out) == args.upload:
+        parser.error("Provide either --out or --upload")
+
+    client = SyncFHIRClient(args.fhir_url)
+    chunks = generate(client, args.patients, args.schedule, args.workers, args.chunk_size)
+    if args.upload:
+        count = upload(client, chunks)
+    else:
+        resources = (resource for _, chunk in chunks for resource in chunk)
+        if bulk_io.detect_format(args.out) == "parquet":
+            count = bulk_io.write_parquet(map(bulk_io.to_recommendation_record, resources), args.out, bulk_io.RECOMMENDATION_SCHEMA)
+        else:
+            count = bulk_io.write_ndjson(resources, args.out)
+    print(f"Generated {count} ImmunizationRecommendation resources")
+
+
+if __name__ == "__main__":
+    main()
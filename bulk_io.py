@@ -0,0 +1,263 @@
+"""
+Streaming import/export of reminder subscriptions and ImmunizationRecommendation resources.
+
+Records flow through generators one at a time (or one Parquet batch at a time), so memory use does not
+grow with the size of the reminder store or the number of recommendations on the FHIR server.
+
+    python bulk_io.py export-reminders reminders.ndjson
+    python bulk_io.py import-reminders reminders.parquet
+    python bulk_io.py export-recommendations recommendations.ndjson
+    python bulk_io.py import-recommendations recommendations.parquet
+"""
+import argparse
+import csv
+import json
+import os
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fhirpy import SyncFHIRClient
+
+import schedule_rules
+import settings
+
+BATCH_SIZE = 10_000
+# resources per FHIR transaction bundle on import
+BUNDLE_SIZE = 100
+
+REMINDER_SCHEMA = pa.schema([
+    ("vaccine", pa.string()),
+    ("disease", pa.string()),
+    ("description", pa.string()),
+    ("recommended_date", pa.string()),
+    ("dose", pa.int64()),
+    ("series", pa.int64()),
+    ("cvx", pa.string()),
+    ("patient_id", pa.string()),
+    ("email", pa.string()),
+    ("is_sent", pa.bool_()),
+    ("date_to_send", pa.string()),
+    ("recurring_until", pa.string()),
+])
+
+RECOMMENDATION_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("patient", pa.string()),
+    ("date", pa.string()),
+    ("schedule_version", pa.string()),
+    ("resource", pa.string()),
+])
+
+
+def detect_format(path, file_format=None):
+    if file_format:
+        return file_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    raise ValueError(f"Cannot infer the format of {path}, use --format ndjson|parquet")
+
+
+def read_ndjson(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_ndjson(records, path):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def read_parquet(path, batch_size=BATCH_SIZE):
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+def write_parquet(records, path, schema, batch_size=BATCH_SIZE):
+    count = 0
+    batch = []
+    with pq.ParquetWriter(path, schema) as writer:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def read_records(path, file_format=None):
+    if detect_format(path, file_format) == "parquet":
+        return read_parquet(path)
+    return read_ndjson(path)
+
+
+def write_records(records, path, schema, file_format=None):
+    if detect_format(path, file_format) == "parquet":
+        return write_parquet(records, path, schema)
+    return write_ndjson(records, path)
+
+
+def to_reminder_record(row):
+    """
+    Type a reminder row read from the CSV store (all strings) or from an import file.
+    """
+    record = {column: row.get(column) or None for column in settings.REMINDER_COLUMNS}
+    for column in ("dose", "series"):
+        if record[column] is not None:
+            record[column] = int(float(record[column]))
+    if isinstance(record["is_sent"], str):
+        record["is_sent"] = record["is_sent"].strip().lower() == "true"
+    record["is_sent"] = bool(record["is_sent"])
+    return record
+
+
+def iter_reminders(path=settings.SCHEDULE_CSV):
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                yield to_reminder_record(row)
+    except FileNotFoundError:
+        return
+
+
+def read_header(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), None)
+
+
+def migrate_reminder_store(path=settings.SCHEDULE_CSV):
+    """
+    Rewrite a store written with an older set of columns to settings.REMINDER_COLUMNS, one row at a time.
+    Columns the store did not have yet are left empty; a store with columns we do not know is rejected.
+    """
+    unknown = [column for column in read_header(path) or [] if column not in settings.REMINDER_COLUMNS]
+    if unknown:
+        raise ValueError(f"{path} has unknown reminder columns: {', '.join(unknown)}")
+    with open(path, newline="", encoding="utf-8") as src, open(f"{path}.tmp", "w", newline="", encoding="utf-8") as dst:
+        writer = csv.DictWriter(dst, fieldnames=settings.REMINDER_COLUMNS)
+        writer.writeheader()
+        writer.writerows(csv.DictReader(src))
+    os.replace(f"{path}.tmp", path)
+
+
+def append_reminders(records, path=settings.SCHEDULE_CSV):
+    """
+    Append reminder records to the CSV store, writing the header if the store is new or empty and migrating a store
+    written with other columns first, so every row lines up with the header.
+    """
+    write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+    if not write_header and read_header(path) != settings.REMINDER_COLUMNS:
+        migrate_reminder_store(path)
+    count = 0
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=settings.REMINDER_COLUMNS, extrasaction="ignore")
+        if write_header:
+            writer.writeheader()
+        for record in records:
+            writer.writerow(to_reminder_record(record))
+            count += 1
+    return count
+
+
+def iter_recommendations(client, identifier=settings.CDC_GROUP_IDENTIFIER_VALUE, page_size=200):
+    """
+    Page through the ImmunizationRecommendation resources on the server, one page in memory at a time.
+    """
+    search_set = client.resources("ImmunizationRecommendation").search(identifier=identifier).limit(page_size)
+    for resource in search_set:
+        yield resource.serialize()
+
+
+def to_recommendation_record(resource):
+    version = next(
+        (tag["code"] for tag in resource.get("meta", {}).get("tag", []) if tag.get("system") == schedule_rules.SCHEDULE_VERSION_SYSTEM),
+        None,
+    )
+    return {
+        "id": resource.get("id"),
+        "patient": resource.get("patient", {}).get("reference"),
+        "date": resource.get("date"),
+        "schedule_version": version,
+        "resource": json.dumps(resource, ensure_ascii=False),
+    }
+
+
+def from_recommendation_record(record):
+    if "resource" in record and isinstance(record["resource"], str):
+        return json.loads(record["resource"])
+    return record
+
+
+def export_recommendations(client, path, file_format=None, identifier=settings.CDC_GROUP_IDENTIFIER_VALUE):
+    resources = iter_recommendations(client, identifier)
+    if detect_format(path, file_format) == "parquet":
+        return write_parquet((to_recommendation_record(resource) for resource in resources), path, RECOMMENDATION_SCHEMA)
+    return write_ndjson(resources, path)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def transaction_entry(resource):
+    """
+    Resources exported with their id are written back to the same id; the others are created.
+    """
+    resource = dict(resource, resourceType="ImmunizationRecommendation")
+    if resource.get("id"):
+        return {"resource": resource, "request": {"method": "PUT", "url": f"ImmunizationRecommendation/{resource['id']}"}}
+    return {"resource": resource, "request": {"method": "POST", "url": "ImmunizationRecommendation"}}
+
+
+def import_recommendations(client, path, file_format=None, bundle_size=BUNDLE_SIZE):
+    """
+    Upload the records as one FHIR transaction bundle per `bundle_size` resources, like batch_generate.upload.
+    """
+    count = 0
+    for chunk in chunked(map(from_recommendation_record, read_records(path, file_format)), bundle_size):
+        bundle = {"resourceType": "Bundle", "type": "transaction", "entry": [transaction_entry(resource) for resource in chunk]}
+        client.execute("", method="post", data=bundle)
+        count += len(chunk)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream reminders and immunization recommendations in and out as NDJSON or Parquet.")
+    parser.add_argument("command", choices=["export-reminders", "import-reminders", "export-recommendations", "import-recommendations"])
+    parser.add_argument("path", help="NDJSON (.ndjson/.jsonl) or Parquet (.parquet) file")
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default=None)
+    parser.add_argument("--schedule-csv", default=settings.SCHEDULE_CSV, help="Reminder store to read from / append to")
+    parser.add_argument("--fhir-url", default=settings.FHIR_BASE_URL)
+    parser.add_argument("--identifier", default=settings.CDC_GROUP_IDENTIFIER_VALUE)
+    args = parser.parse_args()
+
+    if args.command == "export-reminders":
+        count = write_records(iter_reminders(args.schedule_csv), args.path, REMINDER_SCHEMA, args.format)
+    elif args.command == "import-reminders":
+        count = append_reminders(read_records(args.path, args.format), args.schedule_csv)
+    elif args.command == "export-recommendations":
+        count = export_recommendations(SyncFHIRClient(args.fhir_url), args.path, args.format, args.identifier)
+    else:
+        count = import_recommendations(SyncFHIRClient(args.fhir_url), args.path, args.format)
+    print(f"{args.command}: {count} records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,482 @@
+"""
+Pluggable cache shared by the cached FHIR lookups.
+
+The backend is picked by settings.CACHE_URL:
+    memory://                      per process (default, same scope as st.cache_data)
+    sqlite:///path/to/cache.db     shared by every process that can open the file, e.g. app replicas on one host/volume
+    redis://host:6379/0            shared over the network (needs the `redis` package)
+
+Every backend supports a TTL per entry, size-based eviction, invalidation of a whole namespace and invalidation
+of the entries stored with a tag (used by subscriptions.py to drop only what a FHIR change affects).
+"""
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import settings
+
+
+class CacheBackend:
+    def get(self, namespace, key):
+        """
+        :return: (True, value) on a hit, (False, None) on a miss or an expired entry
+        """
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, ttl=None, tags=()):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def invalidate(self, namespace):
+        """
+        Drop every entry of a namespace.
+        """
+        raise NotImplementedError
+
+    def invalidate_tag(self, tag):
+        """
+        Drop every entry stored with the tag, in any namespace.
+        """
+        raise NotImplementedError
+
+    def entries(self):
+        """
+        Yield (namespace, key, pickled value) for every live entry, for memory accounting.
+        """
+        return iter(())
+
+    def stats(self):
+        """
+        :return: dict of namespace -> {"entries": n, "bytes": size of the pickled values}
+        """
+        stats = {}
+        for namespace, _, payload in self.entries():
+            namespace_stats = stats.setdefault(namespace, {"entries": 0, "bytes": 0})
+            namespace_stats["entries"] += 1
+            namespace_stats["bytes"] += len(payload)
+        return stats
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Process-local LRU cache bounded by the total size of the pickled values.
+    """
+
+    def __init__(self, max_bytes=settings.CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.store = OrderedDict()  # (namespace, key) -> (payload, expires_at, tags)
+        self.tags = {}  # tag -> set of (namespace, key)
+        self.lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self.lock:
+            entry = self.store.get((namespace, key))
+            if entry is None:
+                return False, None
+            payload, expires_at, _ = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove((namespace, key))
+                return False, None
+            self.store.move_to_end((namespace, key))
+        return True, pickle.loads(payload)
+
+    def set(self, namespace, key, value, ttl=None, tags=()):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        tags = tuple(tags)
+        with self.lock:
+            self._remove((namespace, key))
+            self.store[(namespace, key)] = (payload, time.time() + ttl if ttl else None, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add((namespace, key))
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.store)))
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self._remove((namespace, key))
+
+    def invalidate(self, namespace):
+        with self.lock:
+            for entry_key in [entry_key for entry_key in self.store if entry_key[0] == namespace]:
+                self._remove(entry_key)
+
+    def invalidate_tag(self, tag):
+        with self.lock:
+            for entry_key in list(self.tags.get(tag, ())):
+                self._remove(entry_key)
+
+    def entries(self):
+        with self.lock:
+            items = list(self.store.items())
+        now = time.time()
+        for (namespace, key), (payload, expires_at, _) in items:
+            if expires_at is None or expires_at >= now:
+                yield namespace, key, payload
+
+    def _remove(self, entry_key):
+        entry = self.store.pop(entry_key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        for tag in entry[2]:
+            tagged = self.tags[tag]
+            tagged.discard(entry_key)
+            if not tagged:
+                del self.tags[tag]
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Cache stored in a SQLite file (WAL mode), shared by all processes that open the same path.
+    Least recently used entries are evicted once the stored values exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=settings.CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                " expires_at REAL, accessed_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_tags ("
+                " tag TEXT NOT NULL, namespace TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, namespace, key))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_tags_entry ON cache_tags (namespace, key)")
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, namespace, key):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return False, None
+        now = time.time()
+        if row[1] is not None and row[1] < now:
+            self._delete(namespace, key, expired_before=now)
+            return False, None
+        connection.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        return True, pickle.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None, tags=()):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, payload, len(payload), now + ttl if ttl else None, now),
+            )
+            connection.execute("DELETE FROM cache_tags WHERE namespace = ? AND key = ?", (namespace, key))
+            connection.executemany(
+                "INSERT OR IGNORE INTO cache_tags (tag, namespace, key) VALUES (?, ?, ?)",
+                [(tag, namespace, key) for tag in tags],
+            )
+            self._evict(connection, now)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self, connection, now):
+        removed = connection.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)).rowcount
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total > self.max_bytes:
+            for namespace, key, size in connection.execute(
+                "SELECT namespace, key, size FROM cache ORDER BY accessed_at"
+            ).fetchall():
+                connection.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                removed += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        if not removed:
+            return
+        connection.execute(
+            "DELETE FROM cache_tags WHERE NOT EXISTS"
+            " (SELECT 1 FROM cache WHERE cache.namespace = cache_tags.namespace AND cache.key = cache_tags.key)"
+        )
+
+    def delete(self, namespace, key):
+        self._delete(namespace, key)
+
+    def _delete(self, namespace, key, expired_before=None):
+        """
+        Delete an entry and its tags; with `expired_before`, only if it expired by then, so an entry another
+        process has just stored again is kept.
+        """
+        condition = "namespace = ? AND key = ?"
+        params = (namespace, key)
+        if expired_before is not None:
+            condition += " AND expires_at < ?"
+            params += (expired_before,)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute(f"DELETE FROM cache WHERE {condition}", params).rowcount:
+                connection.execute("DELETE FROM cache_tags WHERE namespace = ? AND key = ?", (namespace, key))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def invalidate(self, namespace):
+        connection = self._connection()
+        connection.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+        connection.execute("DELETE FROM cache_tags WHERE namespace = ?", (namespace,))
+
+    def invalidate_tag(self, tag):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "DELETE FROM cache WHERE (namespace, key) IN (SELECT namespace, key FROM cache_tags WHERE tag = ?)", (tag,)
+            )
+            connection.execute("DELETE FROM cache_tags WHERE tag = ?", (tag,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def entries(self):
+        rows = self._connection().execute(
+            "SELECT namespace, key, value FROM cache WHERE expires_at IS NULL OR expires_at >= ?", (time.time(),)
+        )
+        yield from rows
+
+    def stats(self):
+        rows = self._connection().execute(
+            "SELECT namespace, COUNT(*), SUM(size) FROM cache WHERE expires_at IS NULL OR expires_at >= ? GROUP BY namespace",
+            (time.time(),),
+        ).fetchall()
+        return {namespace: {"entries": entries, "bytes": size} for namespace, entries, size in rows}
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache stored in Redis. Namespaces are invalidated by bumping a per-namespace generation number, so stale
+    keys are never read again and age out by TTL or LRU eviction. A tag is a Redis set of the keys stored with it.
+
+    The size of every stored value is kept in a hash and its last access time and expiry in two sorted sets, so
+    least recently used entries are evicted once the values exceed max_bytes, like the other backends. Redis's own
+    maxmemory setting still bounds the server as a whole.
+
+    Pass `client` to use an already configured client, e.g. a fakeredis instance when testing locally.
+    """
+
+    def __init__(self, url=None, client=None, default_ttl=24 * 60 * 60, prefix="cs6440", max_bytes=settings.CACHE_MAX_BYTES):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.sizes_key = f"{prefix}:sizes"  # hash: redis key -> size of the value
+        self.accessed_key = f"{prefix}:accessed"  # sorted set: redis key -> last access time
+        self.expires_key = f"{prefix}:expires"  # sorted set: redis key -> expiry time
+        self.bytes_key = f"{prefix}:bytes"  # total size of the values in sizes_key
+
+    def _generation(self, namespace):
+        return decode(self.client.get(f"{self.prefix}:{namespace}:generation") or b"0")
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}:{namespace}:{self._generation(namespace)}:{key}"
+
+    def _split(self, redis_key):
+        namespace, generation, key = decode(redis_key)[len(self.prefix) + 1:].rsplit(":", 2)
+        return namespace, generation, key
+
+    def get(self, namespace, key):
+        redis_key = self._key(namespace, key)
+        pipeline = self.client.pipeline()
+        pipeline.get(redis_key)
+        # xx: only refresh entries still accounted for
+        pipeline.zadd(self.accessed_key, {redis_key: time.time()}, xx=True)
+        payload, _ = pipeline.execute()
+        if payload is None:
+            return False, None
+        return True, pickle.loads(payload)
+
+    def set(self, namespace, key, value, ttl=None, tags=()):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        ttl = int(ttl or self.default_ttl)
+        now = time.time()
+        redis_key = self._key(namespace, key)
+        self._forget([redis_key])
+        pipeline = self.client.pipeline()
+        pipeline.set(redis_key, payload, ex=ttl)
+        pipeline.hset(self.sizes_key, redis_key, len(payload))
+        pipeline.zadd(self.accessed_key, {redis_key: now})
+        pipeline.zadd(self.expires_key, {redis_key: now + ttl})
+        pipeline.incrby(self.bytes_key, len(payload))
+        for tag in tags:
+            tag_key = f"{self.prefix}:tag:{tag}"
+            pipeline.sadd(tag_key, redis_key)
+            # the tag set outlives the keys it lists; extra members only point to expired keys
+            pipeline.expire(tag_key, max(ttl, self.client.ttl(tag_key) or 0))
+        pipeline.execute()
+        self._evict(now)
+
+    def _forget(self, redis_keys):
+        """
+        Drop the size accounting of keys that were deleted or expired. Each key's size is read and removed in one
+        transaction, so when several processes forget the same key only one of them subtracts it.
+
+        :return: number of bytes no longer accounted for
+        """
+        freed = 0
+        for redis_key in redis_keys:
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.hget(self.sizes_key, redis_key)
+            pipeline.hdel(self.sizes_key, redis_key)
+            pipeline.zrem(self.accessed_key, redis_key)
+            pipeline.zrem(self.expires_key, redis_key)
+            size, removed, _, _ = pipeline.execute()
+            if removed:
+                freed += int(size)
+        if freed:
+            self.client.decrby(self.bytes_key, freed)
+        return freed
+
+    def _evict(self, now):
+        expired = self.client.zrangebyscore(self.expires_key, "-inf", now)
+        if expired:
+            self._forget(expired)
+        while int(self.client.get(self.bytes_key) or 0) > self.max_bytes:
+            oldest = self.client.zrange(self.accessed_key, 0, 0)
+            if not oldest:
+                break
+            self.client.delete(*oldest)
+            self._forget(oldest)
+
+    def delete(self, namespace, key):
+        redis_key = self._key(namespace, key)
+        self.client.delete(redis_key)
+        self._forget([redis_key])
+
+    def invalidate(self, namespace):
+        self.client.incr(f"{self.prefix}:{namespace}:generation")
+
+    def invalidate_tag(self, tag):
+        tag_key = f"{self.prefix}:tag:{tag}"
+        keys = self.client.smembers(tag_key)
+        self.client.delete(tag_key, *keys)
+        self._forget(keys)
+
+    def _live_keys(self):
+        """
+        (redis key, namespace, key) of the accounted entries that are neither expired nor in an invalidated generation.
+        """
+        generations = {}
+        for redis_key in self.client.zrangebyscore(self.expires_key, time.time(), "+inf"):
+            namespace, generation, key = self._split(redis_key)
+            if namespace not in generations:
+                generations[namespace] = self._generation(namespace)
+            if generation == generations[namespace]:
+                yield redis_key, namespace, key
+
+    def entries(self):
+        for redis_key, namespace, key in self._live_keys():
+            payload = self.client.get(redis_key)
+            if payload is not None:
+                yield namespace, key, payload
+
+    def stats(self):
+        live = list(self._live_keys())
+        sizes = self.client.hmget(self.sizes_key, [redis_key for redis_key, _, _ in live]) if live else []
+        stats = {}
+        for (_, namespace, _), size in zip(live, sizes):
+            if size is None:
+                continue
+            namespace_stats = stats.setdefault(namespace, {"entries": 0, "bytes": 0})
+            namespace_stats["entries"] += 1
+            namespace_stats["bytes"] += int(size)
+        return stats
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def create_backend(url):
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryCacheBackend()
+    if parsed.scheme == "sqlite":
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        return SQLiteCacheBackend(url[len("sqlite:///"):])
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisCacheBackend(url)
+    raise ValueError(f"Unsupported cache backend: {url}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend():
+    return create_backend(settings.CACHE_URL)
+
+
+def make_key(args, kwargs):
+    return hashlib.sha256(pickle.dumps((args, sorted(kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def cached(namespace, ttl=None, tags=None):
+    """
+    Drop-in replacement for st.cache_data(ttl=...) that stores results in the configured backend.
+    The wrapped function gets a `clear()` that invalidates its namespace.
+
+    `tags` is called with the function's arguments and returns the tags to store the result with. Tagged results
+    are invalidated by FHIR Subscription notifications when those are enabled, so their TTL is raised to
+    settings.SUBSCRIPTION_CACHE_TTL and only acts as a safety net.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = get_backend()
+            key = make_key(args, kwargs)
+            hit, value = backend.get(namespace, key)
+            if hit:
+                return value
+            value = func(*args, **kwargs)
+            entry_ttl = ttl
+            if tags is not None and settings.SUBSCRIPTION_ENDPOINT:
+                entry_ttl = max(ttl or 0, settings.SUBSCRIPTION_CACHE_TTL)
+            backend.set(namespace, key, value, entry_ttl, tags(*args, **kwargs) if tags is not None else ())
+            return value
+
+        wrapper.clear = lambda: get_backend().invalidate(namespace)
+        return wrapper
+
+    return decorator
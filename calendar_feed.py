@@ -0,0 +1,264 @@
+"""
+Per-patient iCalendar (.ics) feeds of the immunization schedule.
+
+A feed is written to settings.CALENDAR_FEED_DIR only when the schedule content changes (tracked by a content
+hash stored next to it, which is also the feed's ETag). `python calendar_feed.py serve` serves the feeds with
+ETag / Last-Modified validation, so a calendar app polling an unchanged feed gets a 304 without the file being read.
+
+Feeds are only published and served when settings.CALENDAR_FEED_SECRET is set.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+PRODID = "-//CS6440//CDC Immunization Schedule Reminder//EN"
+
+
+def schedule_events(model):
+    """
+    One event dict per recommended dose of a schedule_model.ScheduleModel, in date order.
+    """
+    return [
+        {
+            "vaccine": record.vaccine,
+            "cvx": record.cvx or "",
+            "dose": record.dose,
+            "series": record.series,
+            "description": record.description,
+            "start": record.earliest.isoformat(),
+            "end": (record.latest or record.earliest).isoformat(),
+            "created": model.created or "",
+        }
+        for record in model.records if record.earliest is not None
+    ]
+
+
+def content_hash(patient_id, events):
+    """
+    Hash of what the feed shows. The creation date is left out so re-generating the same doses is not a change.
+    """
+    shown = [{key: value for key, value in event.items() if key != "created"} for event in events]
+    canonical = json.dumps([patient_id, shown], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def escape_text(value):
+    return str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def fold(line):
+    """
+    Fold a content line to 75 octets as required by RFC 5545.
+    """
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        limit = 75 if not parts else 74
+        chunk = encoded[:limit]
+        # do not split a multi-byte character
+        while chunk and (chunk[-1] & 0xC0) == 0x80 and len(chunk) < len(encoded):
+            chunk = chunk[:-1]
+        parts.append(chunk.decode())
+        encoded = encoded[len(chunk):]
+    return "\r\n ".join(parts)
+
+
+def ics_date(value):
+    return value[:10].replace("-", "")
+
+
+def ics_timestamp(value):
+    """
+    UTC DATE-TIME for DTSTAMP. Derived from the resource's own date rather than the build time so an unchanged
+    schedule renders to the same bytes.
+    """
+    digits = value[:19].replace("-", "").replace(":", "")
+    return f"{digits}Z" if "T" in digits else f"{digits}T000000Z"
+
+
+def build_ics(patient_id, events, reminder_days=3):
+    calendar_name = f"Immunization schedule - Patient {patient_id}"
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{escape_text(calendar_name)}",
+        "REFRESH-INTERVAL;VALUE=DURATION:P1D",
+        "X-PUBLISHED-TTL:P1D",
+    ]
+    for event in events:
+        summary = f"{event['vaccine']} (Dose {event['dose']} of {event['series']})"
+        # DTEND of an all-day event is exclusive
+        end = datetime.strptime(event["end"][:10], "%Y-%m-%d") + timedelta(days=1)
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{patient_id}-{event['cvx']}-{event['dose']}@cs6440",
+            f"DTSTAMP:{ics_timestamp(event['created'] or event['start'])}",
+            f"DTSTART;VALUE=DATE:{ics_date(event['start'])}",
+            f"DTEND;VALUE=DATE:{end.strftime('%Y%m%d')}",
+            f"SUMMARY:{escape_text(summary)}",
+            f"DESCRIPTION:{escape_text(event['description'])}",
+            "TRANSP:TRANSPARENT",
+            "BEGIN:VALARM",
+            "ACTION:DISPLAY",
+            f"DESCRIPTION:{escape_text('Upcoming immunization: ' + event['vaccine'])}",
+            f"TRIGGER:-P{reminder_days}D",
+            "END:VALARM",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(fold(line) for line in lines) + "\r\n"
+
+
+def feeds_enabled():
+    return bool(settings.CALENDAR_FEED_SECRET)
+
+
+def feed_token(patient_id):
+    """
+    Unguessable feed name for a patient, so the public feed URL does not expose the patient id.
+    """
+    if not feeds_enabled():
+        # with an empty key the name is a plain function of the patient id
+        raise RuntimeError("CALENDAR_FEED_SECRET is not set")
+    return hmac.new(settings.CALENDAR_FEED_SECRET.encode(), patient_id.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def feed_paths(token, directory=settings.CALENDAR_FEED_DIR):
+    return os.path.join(directory, f"{token}.ics"), os.path.join(directory, f"{token}.etag")
+
+
+def read_etag(token, directory=settings.CALENDAR_FEED_DIR):
+    try:
+        with open(feed_paths(token, directory)[1], encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def publish_feed(patient_id, model, directory=settings.CALENDAR_FEED_DIR):
+    """
+    Write the patient's feed if its schedule changed since the last publish.
+
+    :return: (token, etag, changed)
+    """
+    events = schedule_events(model)
+    token = feed_token(patient_id)
+    etag = content_hash(patient_id, events)
+    if read_etag(token, directory) == etag:
+        return token, etag, False
+
+    os.makedirs(directory, exist_ok=True)
+    ics_path, etag_path = feed_paths(token, directory)
+    for path, content in ((ics_path, build_ics(patient_id, events)), (etag_path, etag)):
+        with open(f"{path}.tmp", "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+    return token, etag, True
+
+
+def republish_feed(patient_id, model, directory=settings.CALENDAR_FEED_DIR):
+    """
+    Regenerate a patient's feed after their schedule was changed elsewhere (e.g. assigned by a clinician), if it
+    has been published before; nothing is written for patients whose feed nobody has opened.
+
+    :return: (token, etag, changed), or None if feeds are disabled or the patient has no feed
+    """
+    if not feeds_enabled() or read_etag(feed_token(patient_id), directory) is None:
+        return None
+    return publish_feed(patient_id, model, directory)
+
+
+def feed_url(token):
+    return f"{settings.CALENDAR_FEED_URL.rstrip('/')}/{token}.ics"
+
+
+class CalendarFeedHandler(BaseHTTPRequestHandler):
+    directory = settings.CALENDAR_FEED_DIR
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        name = self.path.split("?")[0].strip("/")
+        token = name[:-len(".ics")] if name.endswith(".ics") else ""
+        etag = read_etag(token, self.directory) if token.isalnum() else None
+        if etag is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        ics_path = feed_paths(token, self.directory)[0]
+        last_modified = datetime.fromtimestamp(int(os.path.getmtime(ics_path)), timezone.utc)
+        quoted_etag = f'"{etag}"'
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        not_modified = False
+        if if_none_match is not None:
+            not_modified = quoted_etag in [value.strip() for value in if_none_match.split(",")] or if_none_match.strip() == "*"
+        elif if_modified_since:
+            try:
+                not_modified = last_modified <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                pass
+
+        headers = {
+            "ETag": quoted_etag,
+            "Last-Modified": format_datetime(last_modified, usegmt=True),
+            "Cache-Control": "private, max-age=3600",
+        }
+        if not_modified:
+            self.send_response(304)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            return
+
+        with open(ics_path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the published immunization calendar feeds.")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8601)
+    parser.add_argument("--directory", default=settings.CALENDAR_FEED_DIR)
+    args = parser.parse_args()
+    if not feeds_enabled():
+        parser.error("Set CALENDAR_FEED_SECRET before serving the feeds")
+
+    CalendarFeedHandler.directory = args.directory
+    server = ThreadingHTTPServer((args.host, args.port), CalendarFeedHandler)
+    print(f"Serving calendar feeds from {args.directory} on http://{args.host}:{args.port}/<token>.ics")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
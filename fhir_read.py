@@ -0,0 +1,58 @@
+"""
+Lean read path for the FHIR searches behind the pages.
+
+Searches ask for only the elements the pages use, go through one keep-alive session per thread that accepts gzip,
+and parse the bundle JSON straight into plain dicts (the same shape fhirpy's `serialize()` returns) instead of
+building resource objects first. Next links are followed until the search is exhausted.
+"""
+import threading
+
+import requests
+
+import settings
+
+PATIENT_ELEMENTS = ("name", "birthDate")
+RECOMMENDATION_ELEMENTS = ("identifier", "patient", "date", "recommendation")
+OBSERVATION_ELEMENTS = ("code", "effectiveDateTime", "valueQuantity", "component")
+
+PAGE_SIZE = 200
+
+_local = threading.local()
+
+
+def get_session():
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update({"Accept": "application/fhir+json", "Accept-Encoding": "gzip"})
+        _local.session = session
+    return session
+
+
+def search(resource_type, params, elements=None, count=PAGE_SIZE, base_url=None, timeout=30):
+    """
+    Yield the resources matched by a search as dicts, page by page.
+
+    Entries of other types (e.g. an OperationOutcome with search warnings) are skipped.
+    """
+    params = dict(params)
+    if elements:
+        params["_elements"] = ",".join(elements)
+    if count:
+        params["_count"] = count
+    url = f"{(base_url or settings.FHIR_BASE_URL).rstrip('/')}/{resource_type}"
+    while url:
+        response = get_session().get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        bundle = response.json()
+        for entry in bundle.get("entry", []):
+            resource = entry.get("resource")
+            if resource is not None and resource.get("resourceType") == resource_type:
+                yield resource
+        # the next link already carries the search parameters
+        url = next((link["url"] for link in bundle.get("link", []) if link.get("relation") == "next"), None)
+        params = None
+
+
+def search_all(resource_type, params, elements=None, **kwargs):
+    return list(search(resource_type, params, elements, **kwargs))
@@ -0,0 +1,444 @@
+"""
+In-memory FHIR R4 stand-in for local load tests and demos.
+
+Implements the subset of the REST API the app uses: read, search (the parameters used by the pages, with
+_count paging, _lastUpdated and _elements, gzip-compressed responses), create, update, delete and transaction bundles, plus rest-hook Subscriptions
+that notify their endpoint when a matching resource is created, updated or deleted. It is seeded with the patients
+listed in patients.csv / patients_with_observation.csv plus synthetic ones, with practitioners, vital-sign
+Observations, administered Immunizations and ImmunizationRecommendations generated from the CDC schedule.
+
+    python fhir_standin.py --port 8080
+    FHIR_BASE_URL=http://localhost:8080 streamlit run main.py
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import urllib.request
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import recommendations
+import schedule_rules
+import settings
+
+DEFAULT_PAGE_SIZE = 20
+FIRST_NAMES = ["Olivia", "Liam", "Emma", "Noah", "Ava", "Elijah", "Sophia", "Lucas", "Mia", "Mateo"]
+LAST_NAMES = ["Nguyen", "Smith", "Garcia", "Johnson", "Brown", "Lee", "Martinez", "Davis", "Lopez", "Wilson"]
+
+# LOINC code -> (display, unit, low, high); blood pressure components are listed under 85354-9
+VITAL_SIGNS = {
+    "8302-2": ("Body height", "cm", 50, 180),
+    "29463-7": ("Body weight", "kg", 3, 80),
+    "8867-4": ("Heart rate", "/min", 60, 140),
+    "39156-5": ("Body mass index", "kg/m2", 14, 26),
+}
+BLOOD_PRESSURE_COMPONENTS = {"8480-6": ("Systolic blood pressure", 90, 130), "8462-4": ("Diastolic blood pressure", 50, 85)}
+
+
+def references(value):
+    if isinstance(value, list):
+        return [reference for item in value for reference in references(item)]
+    if isinstance(value, dict) and value.get("reference"):
+        reference = value["reference"]
+        return [reference, reference.split("/")[-1]]
+    return []
+
+
+def identifier_values(resource):
+    values = []
+    for identifier in resource.get("identifier", []):
+        values.append(identifier.get("value"))
+        if identifier.get("system"):
+            values.append(f"{identifier['system']}|{identifier.get('value')}")
+    return values
+
+
+def names(resource, part):
+    values = []
+    for name in resource.get("name", []):
+        value = name.get(part)
+        values.extend(value if isinstance(value, list) else [value])
+    return [value.lower() for value in values if value]
+
+
+SEARCH_PARAMS = {
+    "_id": lambda resource: [resource.get("id")],
+    "patient": lambda resource: references(resource.get("patient")) or references(resource.get("subject")),
+    "subject": lambda resource: references(resource.get("subject")),
+    "identifier": identifier_values,
+    "general-practitioner": lambda resource: references(resource.get("generalPractitioner")),
+    "birthdate": lambda resource: [resource.get("birthDate")],
+    "given": lambda resource: names(resource, "given"),
+    "family": lambda resource: names(resource, "family"),
+    "name": lambda resource: names(resource, "given") + names(resource, "family"),
+    "status": lambda resource: [resource.get("status")],
+    "url": lambda resource: [resource.get("channel", {}).get("endpoint")],
+    "criteria": lambda resource: [resource.get("criteria")],
+}
+PREFIX_PARAMS = {"given", "family", "name"}
+COMPARATORS = {
+    "eq": lambda value, wanted: value == wanted,
+    "ge": lambda value, wanted: value >= wanted,
+    "gt": lambda value, wanted: value > wanted,
+    "le": lambda value, wanted: value <= wanted,
+    "lt": lambda value, wanted: value < wanted,
+}
+
+
+class FHIRStore:
+    def __init__(self):
+        self.resources = {}  # resource type -> {id: resource}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_sent = Counter()  # response body bytes per method, after compression
+        self.notifications = Counter()  # (method, resource type) -> deliveries, ("error", resource type) -> failures
+        self.deliveries = queue.Queue()
+        self.delivery_thread = None
+
+    def put(self, resource):
+        resource = normalize(resource)
+        resource.setdefault("id", str(uuid.uuid4()))
+        resource["meta"] = {
+            **resource.get("meta", {}),
+            "versionId": str(int(resource.get("meta", {}).get("versionId", "0")) + 1),
+            "lastUpdated": datetime.now(timezone.utc).isoformat(),
+        }
+        if resource["resourceType"] == "Subscription" and resource.get("status") == "requested":
+            resource["status"] = "active"
+        with self.lock:
+            self.resources.setdefault(resource["resourceType"], {})[resource["id"]] = resource
+        self.notify("PUT", resource)
+        return resource
+
+    def get(self, resource_type, resource_id):
+        return self.resources.get(resource_type, {}).get(resource_id)
+
+    def delete(self, resource_type, resource_id):
+        with self.lock:
+            resource = self.resources.get(resource_type, {}).pop(resource_id, None)
+        if resource is not None:
+            self.notify("DELETE", resource)
+        return resource
+
+    def search(self, resource_type, params):
+        criteria = search_criteria(params)
+        with self.lock:
+            candidates = list(self.resources.get(resource_type, {}).values())
+        for value in params.get("_lastUpdated", []):
+            # ISO timestamps in one format compare correctly as strings
+            comparator, wanted = (value[:2], value[2:]) if value[:2] in COMPARATORS else ("eq", value)
+            candidates = [resource for resource in candidates if COMPARATORS[comparator](resource["meta"]["lastUpdated"], wanted)]
+        return [resource for resource in candidates if all(matches(resource, name, wanted) for name, wanted in criteria)]
+
+    def notify(self, method, resource):
+        """
+        Queue a rest-hook notification for every active Subscription whose criteria match the resource.
+        """
+        with self.lock:
+            subscriptions = [subscription for subscription in self.resources.get("Subscription", {}).values() if subscription.get("status") == "active"]
+        for subscription in subscriptions:
+            resource_type, _, query = subscription.get("criteria", "").partition("?")
+            if resource_type != resource["resourceType"]:
+                continue
+            if all(matches(resource, name, wanted) for name, wanted in search_criteria(parse_qs(query))):
+                self.deliveries.put((subscription["channel"], method, resource))
+                with self.lock:
+                    if self.delivery_thread is None:
+                        self.delivery_thread = threading.Thread(target=self.deliver, daemon=True)
+                        self.delivery_thread.start()
+
+    def deliver(self):
+        """
+        Send queued notifications in order: the resource to {endpoint}/{type}/{id} when the channel has a payload,
+        an empty POST to the endpoint otherwise.
+        """
+        while True:
+            channel, method, resource = self.deliveries.get()
+            try:
+                url, data = channel["endpoint"], None
+                if channel.get("payload"):
+                    url = f"{url.rstrip('/')}/{resource['resourceType']}/{resource['id']}"
+                    data = json.dumps(resource).encode() if method == "PUT" else None
+                else:
+                    method = "POST"
+                request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/fhir+json"})
+                for header in channel.get("header", []):
+                    name, _, value = header.partition(":")
+                    request.add_header(name.strip(), value.strip())
+                urllib.request.urlopen(request, timeout=10).close()
+                self.notifications[(method, resource["resourceType"])] += 1
+            except Exception:
+                self.notifications[("error", resource["resourceType"])] += 1
+            finally:
+                self.deliveries.task_done()
+
+    def wait_for_notifications(self):
+        self.deliveries.join()
+
+
+def search_criteria(params):
+    criteria = []
+    for name, values in params.items():
+        name = name.replace("_", "-") if not name.startswith("_") else name
+        if name in SEARCH_PARAMS:
+            wanted = [value.lower() if name in PREFIX_PARAMS else value for value in ",".join(values).split(",")]
+            criteria.append((name, wanted))
+    return criteria
+
+
+def matches(resource, name, wanted):
+    values = SEARCH_PARAMS[name](resource)
+    if name in PREFIX_PARAMS:
+        return any(value.startswith(prefix) for value in values for prefix in wanted)
+    return any(value in wanted for value in values)
+
+
+def normalize(resource):
+    """
+    Store ImmunizationRecommendation.recommendation.targetDisease as a single CodeableConcept (0..1 in R4),
+    the way a real server returns it.
+    """
+    if resource.get("resourceType") == "ImmunizationRecommendation":
+        for recommendation in resource.get("recommendation", []):
+            if isinstance(recommendation.get("targetDisease"), list):
+                recommendation["targetDisease"] = recommendation["targetDisease"][0]
+    return resource
+
+
+def select_elements(resource, elements):
+    if not elements:
+        return resource
+    keep = {"resourceType", "id", "meta"} | set(elements)
+    return {key: value for key, value in resource.items() if key in keep}
+
+
+def read_patient_ids():
+    ids = []
+    for path in ("patients_with_observation.csv", "patients.csv"):
+        if os.path.exists(path):
+            with open(path, newline="", encoding="utf-8") as f:
+                ids.extend(row["id"] for row in csv.DictReader(f) if row.get("id"))
+    return list(dict.fromkeys(ids))
+
+
+def seed(store, patients=200, practitioners=20, observations_per_patient=6, seed_value=6440):
+    rng = random.Random(seed_value)
+    schedule = schedule_rules.load_schedule()
+    today = date.today()
+
+    practitioner_ids = []
+    for index in range(practitioners):
+        practitioner = store.put({
+            "resourceType": "Practitioner",
+            "id": f"standin-practitioner-{index}",
+            "identifier": [{"system": "http://hl7.org/fhir/sid/us-npi", "value": f"{1000000000 + index}"}],
+            "name": [{"given": [rng.choice(FIRST_NAMES)], "family": rng.choice(LAST_NAMES), "prefix": ["Dr."]}],
+        })
+        practitioner_ids.append(practitioner["id"])
+
+    patient_ids = read_patient_ids()
+    patient_ids += [f"standin-patient-{index}" for index in range(max(0, patients - len(patient_ids)))]
+    for patient_id in patient_ids:
+        dob = today - timedelta(days=rng.randint(30, 17 * 365))
+        store.put({
+            "resourceType": "Patient",
+            "id": patient_id,
+            "name": [{"given": [rng.choice(FIRST_NAMES)], "family": rng.choice(LAST_NAMES)}],
+            "birthDate": dob.isoformat(),
+            "generalPractitioner": [{"reference": f"Practitioner/{rng.choice(practitioner_ids)}"}],
+        })
+
+        for visit in range(observations_per_patient):
+            effective = (dob + (today - dob) * (visit + 1) / (observations_per_patient + 1)).isoformat()
+            for code, (display, unit, low, high) in VITAL_SIGNS.items():
+                store.put(observation(patient_id, code, display, effective, value_quantity(low + (high - low) * (visit + 1) / observations_per_patient, unit)))
+            bp = observation(patient_id, "85354-9", "Blood pressure panel", effective, None)
+            bp["component"] = [
+                {"code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+                 "valueQuantity": value_quantity(rng.uniform(low, high), "mm[Hg]")}
+                for code, (display, low, high) in BLOOD_PRESSURE_COMPONENTS.items()
+            ]
+            store.put(bp)
+
+        immunizations = []
+        for vaccine, remaining_doses in schedule.forecast(dob):
+            for dose, earliest, _ in remaining_doses:
+                if earliest < today and rng.random() < 0.6:
+                    immunization = store.put({
+                        "resourceType": "Immunization",
+                        "status": "completed",
+                        "patient": {"reference": f"Patient/{patient_id}"},
+                        "vaccineCode": {"coding": [{"system": schedule_rules.CVX_SYSTEM, "code": vaccine.cvx}]},
+                        "occurrenceDateTime": earliest.isoformat(),
+                    })
+                    immunizations.append(immunization)
+        history = recommendations.immunization_history(immunizations)
+        for resource in recommendations.build_recommendations(schedule, patient_id, dob, history):
+            store.put(resource)
+
+
+def value_quantity(value, unit):
+    return {"value": round(value, 1), "unit": unit, "system": "http://unitsofmeasure.org", "code": unit}
+
+
+def observation(patient_id, code, display, effective, quantity):
+    resource = {
+        "resourceType": "Observation",
+        "status": "final",
+        "identifier": [{"value": settings.CDC_GROUP_IDENTIFIER_VALUE}],
+        "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "effectiveDateTime": effective,
+    }
+    if quantity is not None:
+        resource["valueQuantity"] = quantity
+    return resource
+
+
+class FHIRRequestHandler(BaseHTTPRequestHandler):
+    store = None
+    base_url = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        gzipped = len(payload) > 1024 and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            payload = gzip.compress(payload, compresslevel=5)
+        self.store.bytes_sent[self.command] += len(payload)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def route(self):
+        parsed = urlparse(self.path)
+        parts = [part for part in parsed.path.split("/") if part]
+        params = parse_qs(parsed.query)
+        self.store.requests[(self.command, parts[0] if parts else "")] += 1
+        return parts, params
+
+    def do_GET(self):
+        parts, params = self.route()
+        if len(parts) == 2:
+            resource = self.store.get(*parts)
+            return self.send_json(200, resource) if resource else self.send_json(404, operation_outcome("Not found"))
+        if len(parts) != 1:
+            return self.send_json(404, operation_outcome("Unknown path"))
+        self.send_json(200, self.search_bundle(parts[0], params))
+
+    def search_bundle(self, resource_type, params):
+        results = self.store.search(resource_type, params)
+        if params.get("_summary") == ["count"]:
+            return {"resourceType": "Bundle", "type": "searchset", "total": len(results)}
+        count = int(params.get("_count", [DEFAULT_PAGE_SIZE])[0])
+        offset = int(params.get("_offset", [0])[0])
+        elements = ",".join(params.get("_elements", [])).split(",") if params.get("_elements") else None
+        page = results[offset:offset + count]
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(results),
+            "link": [],
+            "entry": [
+                {"fullUrl": f"{self.base_url}/{resource_type}/{resource['id']}", "resource": select_elements(resource, elements)}
+                for resource in page
+            ],
+        }
+        if offset + count < len(results):
+            next_params = {key: ",".join(values) for key, values in params.items()}
+            next_params["_offset"] = offset + count
+            next_params["_count"] = count
+            bundle["link"].append({"relation": "next", "url": f"{self.base_url}/{resource_type}?{urlencode(next_params)}"})
+        return bundle
+
+    def do_POST(self):
+        parts, _ = self.route()
+        body = self.read_json()
+        if not parts:
+            return self.send_json(200, self.transaction(body))
+        body["resourceType"] = parts[0]
+        body.pop("id", None)
+        self.send_json(201, self.store.put(body))
+
+    def do_PUT(self):
+        parts, _ = self.route()
+        body = self.read_json()
+        body["resourceType"], body["id"] = parts[0], parts[1]
+        self.send_json(200, self.store.put(body))
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        self.store.delete(*parts[:2])
+        self.send_json(204)
+
+    def transaction(self, bundle):
+        entries = []
+        for entry in bundle.get("entry", []):
+            request = entry.get("request", {})
+            resource = entry.get("resource", {})
+            if request.get("method") == "DELETE":
+                self.store.delete(*request["url"].split("/")[:2])
+                entries.append({"response": {"status": "204"}})
+                continue
+            if request.get("method") == "POST":
+                resource.pop("id", None)
+            saved = self.store.put(resource)
+            entries.append({"response": {"status": "201", "location": f"{saved['resourceType']}/{saved['id']}"}})
+        return {"resourceType": "Bundle", "type": "transaction-response", "entry": entries}
+
+
+def operation_outcome(message):
+    return {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found", "diagnostics": message}]}
+
+
+def start_server(host="127.0.0.1", port=0, store=None):
+    """
+    Start the stand-in in a background thread. Returns (server, base_url); call server.shutdown() to stop it.
+    """
+    if store is None:
+        store = FHIRStore()
+        seed(store)
+    server = ThreadingHTTPServer((host, port), FHIRRequestHandler)
+    base_url = f"http://{host}:{server.server_address[1]}"
+    server.RequestHandlerClass = type("BoundFHIRRequestHandler", (FHIRRequestHandler,), {"store": store, "base_url": base_url})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an in-memory FHIR R4 stand-in seeded with test data.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--patients", type=int, default=200)
+    args = parser.parse_args()
+
+    store = FHIRStore()
+    seed(store, patients=args.patients)
+    server, base_url = start_server(args.host, args.port, store)
+    print(f"FHIR stand-in listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Concurrent-session load generator for the Streamlit pages.
+
+Starts the in-memory FHIR stand-in and an SMTP stand-in, then runs N simulated sessions in parallel. Each
+session is its own process driving the real page scripts through Streamlit's AppTest harness (AppTest is not
+thread-safe) with the parent and clinician flows: search patient, view schedule with the health record charts,
+follow schedule, and clinician login / schedule assignment. Reports throughput, latency percentiles per step,
+CPU time and peak RSS per session process, and the request counts seen by the stand-ins.
+
+    python loadtest.py --sessions 8 --duration 60
+    python loadtest.py --sessions 4 --duration 30 --cache-url sqlite:///.cache/loadtest.db --json report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import fhir_standin
+import settings
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SECRETS = {"email": {
+    "SENDER": "reminders@example.com", "PWD": "standin", "SENDER_EMAIL": "reminders@example.com",
+    "SENDER_PASSWORD": "standin", "SMTP_SERVER": "127.0.0.1", "SMTP_PORT": 25,
+}}
+
+
+class SMTPStandinHandler(socketserver.StreamRequestHandler):
+    """
+    Accepts any login and message, counting delivered messages. No STARTTLS.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 smtp-standin ready")
+        while line := self.rfile.readline():
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.wfile.write(b"250-smtp-standin\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command.startswith("AUTH"):
+                self.reply("235 Authentication successful")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPStandin(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages = 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def new_app(page, timeout):
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file(os.path.join(ROOT, page), default_timeout=timeout)
+    for section, values in SECRETS.items():
+        app.secrets[section] = values
+    return app
+
+
+def timed(samples, errors, step, action):
+    start = time.perf_counter()
+    try:
+        app = action()
+        if app is not None and app.exception:
+            errors[step] += 1
+    except Exception:
+        errors[step] += 1
+        app = None
+    samples[step].append(time.perf_counter() - start)
+    return app
+
+
+def parent_flow(rng, samples, errors, timeout):
+    app = new_app("pages/Parent.py", timeout)
+    app = timed(samples, errors, "parent_search_patient", lambda: app.run().radio[0].set_value("No").run())
+    if app is None or not app.selectbox:
+        return
+    patients = app.selectbox[0].options
+    app = timed(samples, errors, "parent_view_schedule_and_charts", lambda: app.selectbox[0].select(rng.choice(patients)).run())
+    email = next((text_input for text_input in app.text_input if text_input.label == "Email Address"), None) if app else None
+    if email is None:
+        return
+    email.input(f"parent{rng.randint(0, 10 ** 6)}@example.com")
+    follow = next((button for button in app.button if button.label == "Follow Schedule"), None)
+    if follow is not None:
+        timed(samples, errors, "parent_follow_schedule", lambda: follow.click().run())
+
+
+def clinician_flow(rng, samples, errors, timeout):
+    app = new_app("pages/Practitioner.py", timeout)
+    app = timed(samples, errors, "clinician_login", lambda: app.run().radio[0].set_value("No").run())
+    if app is None or len(app.radio) < 2:
+        return
+    app = timed(samples, errors, "clinician_view_schedule_and_charts", lambda: app.radio[1].set_value("No").run())
+    if app is None or len(app.selectbox) < 2:
+        return
+    app = timed(samples, errors, "clinician_switch_patient", lambda: app.selectbox[1].select(rng.choice(app.selectbox[1].options)).run())
+    assign = next((button for button in app.button if button.label == "Assign Schedule to Patient"), None) if app else None
+    if assign is not None:
+        timed(samples, errors, "clinician_assign_schedule", lambda: assign.click().run())
+
+
+def run_session(session_index, config):
+    """
+    Runs in a worker process: repeat the flows until the deadline and return the samples and resource usage.
+    """
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    rng = random.Random(session_index)
+    samples, errors = defaultdict(list), defaultdict(int)
+    flows = 0
+    deadline = time.time() + config["duration"]
+    while time.time() < deadline:
+        if rng.random() < config["parent_share"]:
+            parent_flow(rng, samples, errors, config["timeout"])
+        else:
+            clinician_flow(rng, samples, errors, config["timeout"])
+        flows += 1
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "session": session_index,
+        "pid": os.getpid(),
+        "flows": flows,
+        "samples": dict(samples),
+        "errors": dict(errors),
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        # ru_maxrss is in KiB on Linux
+        "max_rss_mb": usage.ru_maxrss / 1024,
+    }
+
+
+def report(results, wall_seconds, store, smtp):
+    samples, errors = defaultdict(list), defaultdict(int)
+    for result in results:
+        for step, values in result["samples"].items():
+            samples[step].extend(values)
+        for step, count in result["errors"].items():
+            errors[step] += count
+    steps = {
+        step: {
+            "count": len(values),
+            "errors": errors.get(step, 0),
+            "throughput_per_s": len(values) / wall_seconds,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p90_ms": percentile(values, 0.9) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": max(values) * 1000,
+        }
+        for step, values in sorted(samples.items())
+    }
+    return {
+        "sessions": len(results),
+        "wall_seconds": wall_seconds,
+        "flows": sum(result["flows"] for result in results),
+        "flows_per_s": sum(result["flows"] for result in results) / wall_seconds,
+        "steps": steps,
+        "processes": [
+            {
+                "session": result["session"],
+                "pid": result["pid"],
+                "cpu_seconds": result["cpu_seconds"],
+                "cpu_percent": 100 * result["cpu_seconds"] / wall_seconds,
+                "max_rss_mb": result["max_rss_mb"],
+            }
+            for result in results
+        ],
+        "fhir_requests": {f"{method} {resource_type}": count for (method, resource_type), count in store.requests.most_common()},
+        "emails_sent": smtp.messages,
+    }
+
+
+def print_report(summary):
+    print(f"{summary['sessions']} sessions, {summary['flows']} flows in {summary['wall_seconds']:.1f}s ({summary['flows_per_s']:.2f} flows/s)")
+    print(f"{'step':40} {'count':>6} {'err':>4} {'/s':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for step, stats in summary["steps"].items():
+        print(f"{step:40} {stats['count']:6d} {stats['errors']:4d} {stats['throughput_per_s']:7.2f} "
+              f"{stats['p50_ms']:8.0f} {stats['p90_ms']:8.0f} {stats['p99_ms']:8.0f} {stats['max_ms']:8.0f}")
+    print(f"{'session':>8} {'pid':>8} {'cpu s':>8} {'cpu %':>7} {'rss MB':>8}")
+    for process in summary["processes"]:
+        print(f"{process['session']:8d} {process['pid']:8d} {process['cpu_seconds']:8.1f} {process['cpu_percent']:7.1f} {process['max_rss_mb']:8.1f}")
+    print("FHIR requests:", ", ".join(f"{key}={count}" for key, count in summary["fhir_requests"].items()))
+    print("Emails sent:", summary["emails_sent"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent parent and clinician sessions against local FHIR/SMTP stand-ins.")
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds each session keeps running flows")
+    parser.add_argument("--parent-share", type=float, default=0.7, help="Fraction of flows that are parent flows")
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--cache-url", default="memory://", help="CACHE_URL for the sessions, e.g. sqlite:///.cache/loadtest.db to share it")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds allowed per script run")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    store = fhir_standin.FHIRStore()
+    fhir_standin.seed(store, patients=args.patients)
+    fhir_server, fhir_url = fhir_standin.start_server(store=store)
+    smtp = SMTPStandin(("127.0.0.1", 0), SMTPStandinHandler)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        schedule_csv = os.path.join(directory, "schedule.csv")
+        with open(schedule_csv, "w", encoding="utf-8") as f:
+            f.write(",".join(settings.REMINDER_COLUMNS) + "\n")
+        # Spawned session processes read these through settings when they import the app modules
+        os.environ.update({
+            "FHIR_BASE_URL": fhir_url,
+            "SMTP_HOST": "127.0.0.1",
+            "SMTP_PORT": str(smtp.server_address[1]),
+            "SMTP_STARTTLS": "0",
+            "SCHEDULE_CSV": schedule_csv,
+            "CACHE_URL": args.cache_url,
+        })
+        config = {"duration": args.duration, "parent_share": args.parent_share, "timeout": args.timeout}
+        start = time.time()
+        with multiprocessing.get_context("spawn").Pool(args.sessions) as pool:
+            results = pool.starmap(run_session, [(index, config) for index in range(args.sessions)])
+        wall_seconds = time.time() - start
+
+    summary = report(results, wall_seconds, store, smtp)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    fhir_server.shutdown()
+    smtp.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,10 @@ import streamlit as st
 from fhirpy import SyncFHIRClient
 import pandas as pd
 
+import memory_accounting
+
 st.set_page_config(page_title="CDC Immunization Schedule Reminder", layout="wide")
+memory_accounting.render_sidebar_report()
 
 st.title("CDC Immunization Schedule Reminder")
 st.markdown("*Please Choose a Role In Sidebar to Continue*")
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+On-demand memory accounting for the running app: bytes held per cache namespace, per session and per FHIR
+resource type, plus tracemalloc snapshots of the whole process.
+
+With settings.MEMORY_REPORT turned on (MEMORY_REPORT=1), open any page with `?memory=1` to show the report in the
+sidebar.
+"""
+import pickle
+import sys
+import tracemalloc
+from collections import Counter
+
+import pandas as pd
+import streamlit as st
+
+import cache_backend
+import settings
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximate number of bytes held by an object and everything it references.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, pd.DataFrame):
+        size += int(obj.memory_usage(deep=True).sum())
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def count_resource_bytes(value, totals):
+    """
+    Add the pickled size of every FHIR resource found in a cached value to totals[resourceType].
+    Nested resources are counted as part of their outermost resource.
+    """
+    if isinstance(value, dict):
+        if "resourceType" in value:
+            totals[value["resourceType"]] += len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            return
+        for item in value.values():
+            count_resource_bytes(item, totals)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            count_resource_bytes(item, totals)
+
+
+def cache_report(backend=None):
+    backend = backend or cache_backend.get_backend()
+    resource_bytes = Counter()
+    for _, _, payload in backend.entries():
+        count_resource_bytes(pickle.loads(payload), resource_bytes)
+    namespaces = backend.stats()
+    return {
+        "budget_bytes": getattr(backend, "max_bytes", settings.CACHE_MAX_BYTES),
+        "total_bytes": sum(namespace["bytes"] for namespace in namespaces.values()),
+        "namespaces": namespaces,
+        "resource_types": dict(resource_bytes),
+    }
+
+
+def active_session_states():
+    """
+    Yield (session id, session state items) for every session of this server process. Falls back to the current
+    session only when the runtime internals are not available (e.g. in bare mode or AppTest).
+    """
+    try:
+        from streamlit.runtime import get_instance
+        session_infos = get_instance()._session_mgr.list_active_sessions()
+        for session_info in session_infos:
+            session = session_info.session
+            yield session.id, dict(session.session_state.filtered_state)
+    except Exception:
+        yield "current", {key: st.session_state[key] for key in st.session_state}
+
+
+def session_report():
+    return {
+        session_id: {
+            "keys": len(state),
+            "bytes": sum(deep_sizeof(value) for value in state.values()),
+            "largest": sorted(((key, deep_sizeof(value)) for key, value in state.items()), key=lambda item: -item[1])[:5],
+        }
+        for session_id, state in active_session_states()
+    }
+
+
+def tracemalloc_report(limit=15):
+    """
+    Snapshot the allocations traced since tracing started. Starts tracing on the first call.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    top = snapshot.statistics("lineno")[:limit]
+    return {
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [(str(stat.traceback[0]), stat.size, stat.count) for stat in top],
+    }
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def render_sidebar_report():
+    if not settings.MEMORY_REPORT or st.query_params.get("memory") != "1":
+        return
+
+    with st.sidebar.expander("Memory", expanded=True):
+        caches = cache_report()
+        st.markdown(f"**Cache** ({settings.CACHE_URL}): {format_bytes(caches['total_bytes'])} of {format_bytes(caches['budget_bytes'])}")
+        st.dataframe(pd.DataFrame(
+            [{"namespace": name, "entries": stats["entries"], "size": format_bytes(stats["bytes"])} for name, stats in caches["namespaces"].items()]
+        ), hide_index=True)
+        st.markdown("**Cached resources by type**")
+        st.dataframe(pd.DataFrame(
+            [{"resource": name, "size": format_bytes(size)} for name, size in sorted(caches["resource_types"].items(), key=lambda item: -item[1])]
+        ), hide_index=True)
+
+        st.markdown("**Sessions**")
+        st.dataframe(pd.DataFrame(
+            [{"session": session_id, "keys": stats["keys"], "size": format_bytes(stats["bytes"])} for session_id, stats in session_report().items()]
+        ), hide_index=True)
+
+        if st.button("Clear caches"):
+            for namespace in caches["namespaces"]:
+                cache_backend.get_backend().invalidate(namespace)
+            st.rerun()
+
+        if st.button("tracemalloc snapshot"):
+            report = tracemalloc_report()
+            if report is None:
+                st.info("Started tracing allocations; take another snapshot to see them.")
+            else:
+                st.markdown(f"Traced: {format_bytes(report['current_bytes'])} (peak {format_bytes(report['peak_bytes'])})")
+                st.dataframe(pd.DataFrame(
+                    [{"line": line, "size": format_bytes(size), "blocks": count} for line, size, count in report["top"]]
+                ), hide_index=True)
@@ -1,18 +1,26 @@
 import re
-from datetime import datetime, timedelta
 
 import pandas as pd
 import streamlit as st
 
+import cache_backend
+import calendar_feed
+import fhir_read
+import memory_accounting
+import schedule_model
+import settings
+import subscriptions
 import utils
 from utils import check_and_send_email, write_schedule_to_csv
 
 st.set_page_config(page_title="CDC Immunization Schedule Reminder", layout="wide")
+memory_accounting.render_sidebar_report()
 st.title("CDC Immunization Schedule Reminder")
 
 st.markdown("You are logged in as **Parent**")
 
 client = utils.get_fhir_client()
+cdc_schedule = utils.load_cdc_schedule()
 
 
 def is_valid_email(email):
@@ -23,11 +31,15 @@ def is_valid_email(email):
     return False
 
 
-# @st.cache_data(ttl=600)
+@cache_backend.cached("immunization_schedules", ttl=600, tags=lambda patient_id: [subscriptions.compartment_tag(patient_id, "ImmunizationRecommendation")])
 def search_immunization_schedule(patient_id):
-    schedule = client.resources('ImmunizationRecommendation').search(patient=patient_id).fetch()
-    res = [s.serialize() for s in schedule]
-    return res
+    # same scope as the ImmunizationRecommendation Subscription, which is what invalidates this entry
+    resources = fhir_read.search_all(
+        'ImmunizationRecommendation',
+        {"patient": patient_id, "identifier": settings.CDC_GROUP_IDENTIFIER_VALUE},
+        fhir_read.RECOMMENDATION_ELEMENTS,
+    )
+    return schedule_model.ScheduleModel(resources)
 
 
 patient = utils.render_search_patient_form()
@@ -38,26 +50,14 @@ if patient:
     if not schedule:
         st.error("No Immunization Schedule found for the selected Patient.")
     else:
-        schedule_as_dict = [
-            {
-                "vaccine": rec["vaccineCode"][0]["coding"][0]["display"],
-                "disease": rec["targetDisease"]["coding"][0]["display"],
-                "description": rec["description"],
-                "recommended_date": ' - '.join([i['value'].replace('-', '/') for i in rec["dateCriterion"]]),
-                "dose": rec["doseNumberPositiveInt"],
-                "series": rec["seriesDosesPositiveInt"],
-            }
-            for _schedule in schedule for rec in _schedule["recommendation"]
-        ]
-
         schedule_tab, health_record_tab = st.tabs(["Immunization Schedule", "Health Record Chart"])
         with schedule_tab:
             st.header("Immunization Recommendation Schedule")
             ident_col, patient_col, first_col, last_col, dob_col, date_col = st.columns(6)
             with ident_col:
-                st.markdown(f'Group Identifier: **{schedule[0]["identifier"][0]["value"]}**', unsafe_allow_html=True)
+                st.markdown(f'Group Identifier: **{schedule.group_identifier}**', unsafe_allow_html=True)
             with patient_col:
-                st.write(f'Patient: **{schedule[0]["patient"]["reference"]}**')
+                st.write(f'Patient: **{schedule.patient_reference}**')
             with first_col:
                 st.write(f'Patient First Name: **{patient["name"][0]["given"][0]}**')
             with last_col:
@@ -65,10 +65,21 @@ if patient:
             with dob_col:
                 st.write(f'Patient DOB: **{patient["birthDate"]}**')
             with date_col:
-                st.write(f'Created Date: **{schedule[0]["date"]}**')
+                st.write(f'Created Date: **{schedule.created}**')
 
-            df = pd.DataFrame(schedule_as_dict).sort_values("recommended_date")
-            st.dataframe(df, hide_index=True)
+            utils.render_schedule_table(schedule)
+            ics_col, url_col = st.columns([1, 4])
+            if calendar_feed.feeds_enabled():
+                token, _, _ = calendar_feed.publish_feed(patient['id'], schedule)
+                with open(calendar_feed.feed_paths(token)[0], "rb") as f:
+                    ics = f.read()
+                with url_col:
+                    st.text_input("Subscribe in your calendar app with this URL:", calendar_feed.feed_url(token), disabled=True)
+            else:
+                # No secret, no public feed: the schedule can still be downloaded once
+                ics = calendar_feed.build_ics(patient['id'], calendar_feed.schedule_events(schedule)).encode()
+            with ics_col:
+                st.download_button("Add to calendar (.ics)", ics, file_name=f"immunization_schedule_{patient['id']}.ics", mime="text/calendar")
             with st.form(key='reminder_form'):
                 e_label, email_col, d_label, d_col, send_btn = st.columns([3, 6, 0.7, 0.5, 1])
                 with e_label:
@@ -83,14 +94,8 @@ if patient:
                     send = st.form_submit_button("Follow Schedule")
                 if send:
                     if is_valid_email(email) and day_ahead:
-                        df['patient_id'] = patient['id']
-                        df['email'] = email
-                        df['is_sent'] = False
-                        df['first_day_to_get'] = df['recommended_date'].apply(lambda x: datetime.strptime(x.split(" - ")[0], "%Y/%m/%d"))
-                        df['date_to_send'] = df['first_day_to_get'].apply(lambda x: x - timedelta(days=day_ahead))
-                        df['date_to_send'] = df['date_to_send'].dt.strftime('%Y/%m/%d')
-                        df = df.drop(columns=['first_day_to_get'])
-                        write_schedule_to_csv(df)
+                        reminders = schedule.reminders(patient['id'], email, day_ahead, cdc_schedule, patient['birthDate'])
+                        write_schedule_to_csv(pd.DataFrame(reminders, columns=settings.REMINDER_COLUMNS))
                         st.success("Followed successfully!")
                         check_and_send_email()
                     else:
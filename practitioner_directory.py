@@ -0,0 +1,174 @@
+"""
+In-memory directory of every Practitioner on the FHIR server, for the clinician login.
+
+The first refresh pages through the whole Practitioner set with only the fields the directory shows; later
+refreshes ask for the practitioners updated since the newest `meta.lastUpdated` seen. Those cannot see deletions,
+so the whole set is reloaded and swapped in every `reload_age` seconds. Typeahead matches prefixes
+of name parts, ids and identifier values through a sorted token index, so it never goes to the server. Patient
+counts are fetched with `_summary=count` the first time an entry is shown after each refresh.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 500
+COUNT_WORKERS = 8
+
+
+class PractitionerEntry:
+    __slots__ = ("id", "name", "identifiers", "last_updated", "patient_count", "tokens")
+
+    def __init__(self, resource):
+        self.id = resource["id"]
+        self.name = display_name(resource)
+        self.identifiers = [identifier["value"] for identifier in resource.get("identifier", []) if identifier.get("value")]
+        self.last_updated = resource.get("meta", {}).get("lastUpdated")
+        self.patient_count = None
+        self.tokens = sorted({token for value in [self.id, *self.identifiers, *self.name.split()] if (token := normalize(value))})
+
+    def label(self):
+        identifiers = f" ({', '.join(self.identifiers)})" if self.identifiers else ""
+        patients = "" if self.patient_count is None else f" - {self.patient_count} patients"
+        return f"{self.name or self.id}{identifiers}{patients}"
+
+
+def display_name(resource):
+    for name in resource.get("name", []):
+        if name.get("text"):
+            return name["text"]
+        parts = [*name.get("prefix", []), *name.get("given", []), name.get("family", "")]
+        if any(parts):
+            return " ".join(part for part in parts if part)
+    return ""
+
+
+def normalize(value):
+    return value.strip(" ,.").lower() if value else ""
+
+
+class PractitionerDirectory:
+    def __init__(self, client, page_size=PAGE_SIZE):
+        self.client = client
+        self.page_size = page_size
+        self.entries = {}
+        self.index = []  # sorted (token, practitioner id)
+        self.last_updated = None
+        self.refreshed_at = None
+        self.loaded_at = None  # time of the last full load
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def refresh(self, full=False):
+        """
+        Fetch the practitioners created or updated since the last refresh. A full refresh (always the first one)
+        fetches all of them and replaces the directory, which drops the practitioners deleted since.
+
+        :return: number of entries added or updated
+        """
+        full = full or self.loaded_at is None or not self.last_updated
+        params = {"_count": self.page_size}
+        if not full:
+            # `ge` re-reads the practitioners updated in the same instant as the last one seen instead of missing them
+            params["_lastUpdated"] = f"ge{self.last_updated}"
+        search_set = self.client.resources("Practitioner").search(**params).elements("name", "identifier", "meta")
+
+        if full:
+            entries = {}
+            for practitioner in search_set:
+                entry = PractitionerEntry(practitioner.serialize())
+                entries[entry.id] = entry
+            index = sorted((token, entry.id) for entry in entries.values() for token in entry.tokens)
+            last_updated = max((entry.last_updated for entry in entries.values() if entry.last_updated), default=None)
+            with self.lock:
+                self.entries, self.index, self.last_updated = entries, index, last_updated
+            self.refreshed_at = self.loaded_at = time.time()
+            return len(entries)
+
+        with self.lock:
+            # patients move between practitioners without the Practitioner changing, so recount after each refresh
+            for entry in self.entries.values():
+                entry.patient_count = None
+
+        changed = {}
+        for practitioner in search_set:
+            entry = PractitionerEntry(practitioner.serialize())
+            previous = self.entries.get(entry.id)
+            if previous is None or previous.last_updated != entry.last_updated:
+                changed[entry.id] = entry
+
+        if changed:
+            with self.lock:
+                self.entries.update(changed)
+                # one sort per refresh instead of one insert per token, which is quadratic on the first load
+                self.index = sorted(
+                    [item for item in self.index if item[1] not in changed]
+                    + [(token, entry.id) for entry in changed.values() for token in entry.tokens]
+                )
+                self.last_updated = max(
+                    [self.last_updated or "", *(entry.last_updated for entry in changed.values() if entry.last_updated)]
+                ) or None
+        self.refreshed_at = time.time()
+        return len(changed)
+
+    def is_stale(self, max_age):
+        return self.refreshed_at is None or time.time() - self.refreshed_at > max_age
+
+    def needs_reload(self, reload_age):
+        return self.loaded_at is None or (reload_age is not None and time.time() - self.loaded_at > reload_age)
+
+    def refresh_if_stale(self, max_age, reload_age=None):
+        if not self.is_stale(max_age) and not self.needs_reload(reload_age):
+            return
+        # the first load makes the other sessions wait for it; later refreshes let them keep using the current index
+        if self.refresh_lock.acquire(blocking=self.refreshed_at is None):
+            try:
+                if self.needs_reload(reload_age):
+                    self.refresh(full=True)
+                elif self.is_stale(max_age):
+                    self.refresh()
+            finally:
+                self.refresh_lock.release()
+
+    def get(self, practitioner_id):
+        return self.entries.get(practitioner_id)
+
+    def prefix_matches(self, prefix):
+        with self.lock:
+            position = bisect_left(self.index, (prefix, ""))
+            ids = set()
+            while position < len(self.index) and self.index[position][0].startswith(prefix):
+                ids.add(self.index[position][1])
+                position += 1
+        return ids
+
+    def search(self, query, limit=20):
+        """
+        Entries matching every word of the query as a prefix of a name part, the id or an identifier, by name.
+        """
+        tokens = [token for word in query.split() if (token := normalize(word))]
+        if tokens:
+            ids = set.intersection(*(self.prefix_matches(token) for token in tokens))
+            matches = [self.entries[practitioner_id] for practitioner_id in ids]
+        else:
+            matches = list(self.entries.values())
+        return heapq.nsmallest(limit, matches, key=lambda entry: (entry.name.lower(), entry.id))
+
+    def count_patients(self, entries):
+        """
+        Fill in the patient counts missing from the given entries, a few `_summary=count` searches at a time.
+        """
+        missing = [entry for entry in entries if entry.patient_count is None]
+
+        def count(entry):
+            bundle = self.client.resources("Patient").search(general_practitioner=entry.id, _summary="count").fetch_raw()
+            entry.patient_count = bundle.get("total", 0)
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(COUNT_WORKERS, len(missing))) as executor:
+                list(executor.map(count, missing))
+        return entries
@@ -0,0 +1,64 @@
+"""
+Plain-dict builders for ImmunizationRecommendation resources.
+
+These do not touch the FHIR client, so they can run in worker processes and be serialized with json directly.
+"""
+from datetime import datetime
+
+import schedule_rules
+import settings
+
+
+def build_date_criterion(earliest, latest):
+    if latest is None:
+        return [{"code": [{"text": "Recommended Date"}], "value": earliest.strftime("%Y-%m-%d")}]
+    return [
+        {"code": [{"text": "Earliest Date"}], "value": earliest.strftime("%Y-%m-%d")},
+        {"code": [{"text": "Latest Date"}], "value": latest.strftime("%Y-%m-%d")},
+    ]
+
+
+def immunization_history(immunizations):
+    """
+    Group serialized Immunization resources by the CVX code they were recorded with. The schedule's forecast
+    regroups them by vaccine, so brand and combination vaccine codes count too.
+
+    :return: dict of cvx code -> sorted list of administration dates, completed immunizations only
+    """
+    history = {}
+    for immunization in immunizations:
+        occurrence = immunization.get("occurrenceDateTime")
+        if immunization.get("status") != "completed" or not occurrence:
+            continue
+        administered_date = datetime.strptime(occurrence[:10], "%Y-%m-%d").date()
+        for coding in immunization.get("vaccineCode", {}).get("coding", []):
+            if coding.get("system") == schedule_rules.CVX_SYSTEM and coding.get("code"):
+                history.setdefault(coding["code"], []).append(administered_date)
+    return {cvx: sorted(dates) for cvx, dates in history.items()}
+
+
+def build_recommendations(schedule, patient_id, patient_dob, history=None, created=None):
+    """
+    Build one ImmunizationRecommendation per vaccine with doses remaining for the patient.
+    """
+    created = created or datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z")
+    return [
+        {
+            "resourceType": "ImmunizationRecommendation",
+            "meta": {"tag": [schedule.version_tag()]},
+            "identifier": [{"value": settings.CDC_GROUP_IDENTIFIER_VALUE}],
+            "patient": {"reference": f"Patient/{patient_id}"},
+            "date": created,
+            "recommendation": [
+                {
+                    "vaccineCode": [{"coding": [{"system": schedule_rules.CVX_SYSTEM, "code": vaccine.cvx, "display": f"{vaccine.vaccine} vaccine"}]}],
+                    "targetDisease": [{"coding": [{"system": "http://snomed.info/sct", "display": vaccine.disease}]}],
+                    "dateCriterion": build_date_criterion(earliest, latest),
+                    "description": dose.description,
+                    "doseNumberPositiveInt": dose.dose,
+                    "seriesDosesPositiveInt": dose.series,
+                } for dose, earliest, latest in remaining_doses
+            ],
+        }
+        for vaccine, remaining_doses in schedule.forecast(patient_dob, history)
+    ]
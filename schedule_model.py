@@ -0,0 +1,125 @@
+"""
+Flat, typed view of a patient's ImmunizationRecommendation resources, shared by the Parent and Practitioner pages.
+
+A ScheduleModel is built once per fetched schedule and cached with it; the pages display, sort, derive reminders
+and export from its records instead of re-flattening the nested JSON on every rerun. Dates are `date` objects;
+they are formatted as "YYYY/MM/DD" only where the reminder store and the emails expect text.
+"""
+from datetime import date, timedelta
+
+import pandas as pd
+
+import schedule_rules
+
+DATE_FORMAT = "%Y/%m/%d"
+
+DISPLAY_COLUMNS = ["vaccine", "disease", "description", "recommended_from", "recommended_to", "dose", "series"]
+
+
+class RecommendationRecord:
+    __slots__ = ("vaccine", "disease", "description", "earliest", "latest", "dose", "series", "cvx")
+
+    def __init__(self, vaccine, disease, description, earliest, latest, dose, series, cvx):
+        self.vaccine = vaccine
+        self.disease = disease
+        self.description = description
+        self.earliest = earliest
+        self.latest = latest
+        self.dose = dose
+        self.series = series
+        self.cvx = cvx
+
+    @classmethod
+    def from_recommendation(cls, rec):
+        coding = rec["vaccineCode"][0]["coding"][0]
+        dates = [date.fromisoformat(criterion["value"][:10]) for criterion in rec.get("dateCriterion", [])]
+        return cls(
+            vaccine=coding.get("display", ""),
+            disease=disease_display(rec.get("targetDisease")),
+            description=rec.get("description", ""),
+            earliest=dates[0] if dates else None,
+            # a single "Recommended Date" criterion has no separate latest date
+            latest=dates[-1] if len(dates) > 1 else None,
+            dose=rec.get("doseNumberPositiveInt"),
+            series=rec.get("seriesDosesPositiveInt"),
+            cvx=coding.get("code"),
+        )
+
+    def recommended_date(self):
+        """
+        Text form stored in the reminder CSV and used in the emails: "YYYY/MM/DD - YYYY/MM/DD".
+        """
+        return " - ".join(day.strftime(DATE_FORMAT) for day in (self.earliest, self.latest) if day is not None)
+
+
+def disease_display(target_disease):
+    """
+    targetDisease is a list when we build the resource and a single CodeableConcept (0..1 in R4) when a server
+    returns it.
+    """
+    if isinstance(target_disease, list):
+        target_disease = target_disease[0] if target_disease else None
+    if not target_disease:
+        return ""
+    return target_disease.get("coding", [{}])[0].get("display", "")
+
+
+class ScheduleModel:
+    __slots__ = ("group_identifier", "patient_reference", "created", "records")
+
+    def __init__(self, resources):
+        first = resources[0] if resources else {}
+        self.group_identifier = first.get("identifier", [{}])[0].get("value")
+        self.patient_reference = first.get("patient", {}).get("reference")
+        self.created = first.get("date")
+        self.records = sorted(
+            (RecommendationRecord.from_recommendation(rec) for resource in resources for rec in resource.get("recommendation", [])),
+            key=lambda record: (record.earliest or date.max, record.vaccine, record.dose or 0),
+        )
+
+    def __len__(self):
+        return len(self.records)
+
+    def to_dataframe(self):
+        """
+        Display frame, already in date order, with real date columns.
+        """
+        return pd.DataFrame({
+            "vaccine": [record.vaccine for record in self.records],
+            "disease": [record.disease for record in self.records],
+            "description": [record.description for record in self.records],
+            "recommended_from": pd.to_datetime([record.earliest for record in self.records]),
+            "recommended_to": pd.to_datetime([record.latest for record in self.records]),
+            "dose": [record.dose for record in self.records],
+            "series": [record.series for record in self.records],
+        }, columns=DISPLAY_COLUMNS)
+
+    def reminders(self, patient_id, email, days_ahead, cdc_schedule=None, patient_dob=None):
+        """
+        Rows for the reminder store (settings.REMINDER_COLUMNS), one per recommended dose. Recurring vaccines get
+        `recurring_until` from the compiled schedule when one is given.
+        """
+        dob = schedule_rules.to_date(patient_dob) if patient_dob else None
+        rows = []
+        for record in self.records:
+            if record.earliest is None:
+                continue
+            vaccine = cdc_schedule.by_cvx.get(record.cvx) if cdc_schedule is not None else None
+            recurring_until = None
+            if vaccine is not None and vaccine.recurring is not None and dob is not None:
+                recurring_until = vaccine.recurring_until(dob).strftime(DATE_FORMAT)
+            rows.append({
+                "vaccine": record.vaccine,
+                "disease": record.disease,
+                "description": record.description,
+                "recommended_date": record.recommended_date(),
+                "dose": record.dose,
+                "series": record.series,
+                "cvx": record.cvx,
+                "patient_id": patient_id,
+                "email": email,
+                "is_sent": False,
+                "date_to_send": (record.earliest - timedelta(days=days_ahead)).strftime(DATE_FORMAT),
+                "recurring_until": recurring_until,
+            })
+        return rows
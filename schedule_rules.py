@@ -0,0 +1,339 @@
+import calendar
+import json
+import os
+from datetime import date, datetime, timedelta
+
+DEFAULT_SCHEDULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cdc_schedule.json")
+CVX_SYSTEM = "http://hl7.org/fhir/sid/cvx"
+SCHEDULE_VERSION_SYSTEM = "urn:cs6440:cdc-schedule-version"
+
+# unit -> (months, days) per unit
+DURATION_UNITS = {"D": (0, 1), "W": (0, 7), "M": (1, 0), "Y": (12, 0)}
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def parse_duration(value):
+    """
+    Convert a schedule duration such as "6W", "4M" or "11Y" into a (months, days) pair.
+    """
+    value = value.strip().upper()
+    unit = DURATION_UNITS.get(value[-1:])
+    if unit is None or not value[:-1].isdigit():
+        raise ScheduleError(f"Invalid duration in schedule: {value!r}")
+    amount = int(value[:-1])
+    return unit[0] * amount, unit[1] * amount
+
+
+def add_duration(start, duration):
+    """
+    Add a (months, days) duration to a date, clamping to the end of the month like relativedelta does.
+    """
+    months, days = duration
+    if months:
+        years, month = divmod(start.month - 1 + months, 12)
+        year = start.year + years
+        start = date(year, month + 1, min(start.day, calendar.monthrange(year, month + 1)[1]))
+    if days:
+        start += timedelta(days=days)
+    return start
+
+
+def parse_age_range(age):
+    if "-" in age:
+        start_age, end_age = age.split("-")
+        return parse_duration(start_age), parse_duration(end_age)
+    return parse_duration(age), None
+
+
+class Condition:
+    """
+    "Dose N (or the previous dose) was administered at an age within [min_age, max_age)", or with dose "current",
+    "the patient's age on the day the dose is planned or was given is within [min_age, max_age)".
+    """
+    __slots__ = ("dose", "min_age", "max_age")
+
+    def __init__(self, dose, min_age=None, max_age=None):
+        self.dose = dose
+        self.min_age = parse_duration(min_age) if min_age else None
+        self.max_age = parse_duration(max_age) if max_age else None
+
+    def matches(self, dob, dose_number, administered_dates, today):
+        if self.dose == "current":
+            administered = today
+        else:
+            reference = dose_number - 1 if self.dose == "previous" else self.dose
+            if reference < 1 or reference > len(administered_dates):
+                return False
+            administered = administered_dates[reference - 1]
+        if self.min_age is not None and administered < add_duration(dob, self.min_age):
+            return False
+        if self.max_age is not None and administered >= add_duration(dob, self.max_age):
+            return False
+        return True
+
+
+class AllConditions:
+    """
+    {"all": [...]}: every one of the conditions holds.
+    """
+    __slots__ = ("conditions",)
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    def matches(self, dob, dose_number, administered_dates, today):
+        return all(condition.matches(dob, dose_number, administered_dates, today) for condition in self.conditions)
+
+
+def parse_condition(spec):
+    if "all" in spec:
+        return AllConditions(tuple(parse_condition(condition) for condition in spec["all"]))
+    return Condition(**spec)
+
+
+class DoseRule:
+    __slots__ = (
+        "dose", "series", "description", "start_age", "end_age", "min_age", "min_ages", "min_intervals", "skip_if",
+        "final_if",
+    )
+
+    def __init__(self, spec):
+        self.dose = spec["dose"]
+        self.series = spec["series"]
+        self.description = spec["description"]
+        self.start_age, self.end_age = parse_age_range(spec["age"])
+        self.min_age = parse_duration(spec["min_age"]) if spec.get("min_age") else None
+        # minimum ages that only apply under a condition, e.g. "age 12 through 59 months (as final dose)"
+        self.min_ages = tuple(
+            (parse_duration(min_age["age"]), parse_condition(min_age["when"])) for min_age in spec.get("min_ages", [])
+        )
+        self.min_intervals = tuple(
+            (
+                interval["after_dose"],
+                parse_duration(interval["interval"]),
+                parse_condition(interval["when"]) if interval.get("when") else None,
+            )
+            for interval in spec.get("min_intervals", [])
+        )
+        self.skip_if = tuple(parse_condition(condition) for condition in spec.get("skip_if", []))
+        # "(as final dose)": no later dose of the series is needed once this one is given
+        self.final_if = tuple(parse_condition(condition) for condition in spec.get("final_if", []))
+        for after_dose, _, _ in self.min_intervals:
+            if not 1 <= after_dose < self.dose:
+                raise ScheduleError(f"Dose {self.dose} has an interval after dose {after_dose}")
+
+    def is_skipped(self, dob, administered_dates, today):
+        return any(condition.matches(dob, self.dose, administered_dates, today) for condition in self.skip_if)
+
+    def is_final(self, dob, administered_dates, today):
+        """
+        For a dose already given, pass its administration date as `today`.
+        """
+        return any(condition.matches(dob, self.dose, administered_dates, today) for condition in self.final_if)
+
+    def date_window(self, dob, dose_dates, administered_dates, today):
+        """
+        Return (earliest, latest) for this dose. An overdue dose is due `today`, so the intervals of the doses
+        after it are counted from today rather than from a date already past. The latest date is None when the dose
+        has a single recommended date, or when the minimum age/interval rules push it past the end of its age range.
+        """
+        earliest = add_duration(dob, self.start_age)
+        latest = add_duration(dob, self.end_age) if self.end_age is not None else None
+        if self.min_age is not None:
+            earliest = max(earliest, add_duration(dob, self.min_age))
+        for min_age, when in self.min_ages:
+            if when.matches(dob, self.dose, administered_dates, today):
+                earliest = max(earliest, add_duration(dob, min_age))
+        for after_dose, interval, when in self.min_intervals:
+            if after_dose <= len(dose_dates) and (when is None or when.matches(dob, self.dose, administered_dates, today)):
+                earliest = max(earliest, add_duration(dose_dates[after_dose - 1], interval))
+        earliest = max(earliest, today)
+        if latest is not None and earliest > latest:
+            latest = None
+        return earliest, latest
+
+
+class RecurringDose:
+    """
+    A seasonal dose given after the initial series, e.g. the annual influenza dose.
+    """
+    __slots__ = ("dose", "series", "description")
+
+    def __init__(self, dose, series, description):
+        self.dose = dose
+        self.series = series
+        self.description = description
+
+
+class RecurrenceRule:
+    __slots__ = ("season_start", "season_end", "until_age")
+
+    def __init__(self, spec):
+        self.season_start = parse_month_day(spec["season_start"])
+        self.season_end = parse_month_day(spec["season_end"])
+        self.until_age = parse_duration(spec["until_age"])
+
+    def season_of(self, year):
+        start = date(year, *self.season_start)
+        end_year = year + 1 if self.season_end < self.season_start else year
+        return start, date(end_year, *self.season_end)
+
+    def season_year(self, day):
+        """
+        Year in which the season containing `day`, or the last one started before it, starts.
+        """
+        return day.year if (day.month, day.day) >= self.season_start else day.year - 1
+
+    def current_season(self, today):
+        """
+        The season in progress on `today`, or the next one when `today` falls between seasons.
+        """
+        start, end = self.season_of(self.season_year(today))
+        return (start, end) if end >= today else self.season_of(start.year + 1)
+
+    def seasons(self, after, until=None, today=None):
+        """
+        Lazily yield (start, end) for every season after the one containing `after`, beginning no earlier than
+        the current season on `today`, and stopping once a season would start after `until`.
+        """
+        year = self.season_year(after) + 1
+        if today is not None:
+            year = max(year, self.current_season(today)[0].year)
+        while True:
+            start, end = self.season_of(year)
+            if until is not None and start > until:
+                return
+            yield start, end
+            year += 1
+
+
+class VaccineRule:
+    __slots__ = ("vaccine", "cvx", "cvx_codes", "disease", "total_series", "vaccine_info", "doses", "recurring")
+
+    def __init__(self, spec):
+        self.vaccine = spec["vaccine"]
+        self.cvx = spec["cvx"]
+        # every code a dose of this vaccine can be recorded with: brands, formulations and combination vaccines
+        self.cvx_codes = tuple(dict.fromkeys([self.cvx, *spec.get("cvx_codes", [])]))
+        self.disease = spec["disease"]
+        self.total_series = spec["total_series"]
+        self.vaccine_info = spec.get("vaccine_info", "")
+        self.doses = tuple(DoseRule(dose) for dose in spec["doses"])
+        self.recurring = RecurrenceRule(spec["recurring"]) if spec.get("recurring") else None
+
+    def recurring_until(self, dob):
+        return add_duration(dob, self.recurring.until_age) if self.recurring is not None else None
+
+    def forecast(self, dob, administered_dates=(), today=None):
+        """
+        Match the administered doses against the series and return the remaining doses as
+        (DoseRule, earliest, latest), in dose order. Once the series is complete, a recurring vaccine
+        returns only its next season from `today` on; later seasons are materialized one at a time by the reminders.
+        """
+        today = today or date.today()
+        administered_dates = list(administered_dates)
+        dose_dates = list(administered_dates)
+        remaining = []
+        given = self.doses[:len(administered_dates)]
+        # a final dose already given completes the series
+        completed = any(dose.is_final(dob, administered_dates, administered) for dose, administered in zip(given, administered_dates))
+        for dose in () if completed else self.doses[len(given):]:
+            if dose.is_skipped(dob, administered_dates, today):
+                break
+            earliest, latest = dose.date_window(dob, dose_dates, administered_dates, today)
+            dose_dates.append(earliest)
+            remaining.append((dose, earliest, latest))
+            if dose.is_final(dob, administered_dates, today):
+                break
+
+        if self.recurring is None:
+            return remaining
+        until = self.recurring_until(dob)
+        if remaining and not administered_dates:
+            # a child who never had the seasonal dose gets it within this season, not at an age long past
+            start, end = self.recurring.current_season(today)
+            dose, earliest, latest = remaining[0]
+            if earliest <= end and start <= until:
+                remaining[0] = (dose, max(start, earliest), end)
+        elif not remaining and administered_dates:
+            season = next(self.recurring.seasons(administered_dates[-1], until, today), None)
+            if season is not None:
+                last_dose = self.doses[-1]
+                # every season repeats the last dose of the series, so it keeps its number
+                dose = RecurringDose(last_dose.dose, last_dose.series, last_dose.description)
+                remaining.append((dose, *season))
+        return remaining
+
+
+class CompiledSchedule:
+    __slots__ = ("version", "source", "vaccines", "by_cvx", "by_code")
+
+    def __init__(self, spec):
+        if not spec.get("version"):
+            raise ScheduleError("Schedule file has no version")
+        self.version = str(spec["version"])
+        self.source = spec.get("source", "")
+        self.vaccines = tuple(VaccineRule(vaccine) for vaccine in spec["vaccines"])
+        self.by_cvx = {vaccine.cvx: vaccine for vaccine in self.vaccines}
+        # any recorded cvx code -> the vaccines it counts for; a combination vaccine counts for each component
+        self.by_code = {}
+        for vaccine in self.vaccines:
+            for code in vaccine.cvx_codes:
+                self.by_code.setdefault(code, []).append(vaccine)
+
+    def __iter__(self):
+        return iter(self.vaccines)
+
+    def forecast(self, dob, history=None, today=None):
+        """
+        Evaluate a patient history against every vaccine of the schedule.
+
+        :param dob: date of birth (date or "YYYY-MM-DD")
+        :param history: dict of recorded cvx code -> list of administration dates
+        :param today: date overdue doses are moved to and recurring seasons are counted from, today by default
+        :return: list of (VaccineRule, [(DoseRule, earliest, latest), ...]) for vaccines with doses remaining
+        """
+        dob = to_date(dob)
+        history = self.vaccine_history(history or {})
+        results = []
+        for vaccine in self.vaccines:
+            remaining = vaccine.forecast(dob, history.get(vaccine.cvx, ()), today)
+            if remaining:
+                results.append((vaccine, remaining))
+        return results
+
+    def vaccine_history(self, history):
+        """
+        Regroup a history keyed by recorded cvx code by vaccine (its primary code). A dose recorded with several
+        codes of the same vaccine on one day counts once.
+        """
+        dates = {}
+        for code, administered in history.items():
+            # "8" and "08" are both seen in the wild
+            for vaccine in self.by_code.get(code.zfill(2), ()):
+                dates.setdefault(vaccine.cvx, set()).update(administered)
+        return {cvx: sorted(administered) for cvx, administered in dates.items()}
+
+    def version_tag(self):
+        return {"system": SCHEDULE_VERSION_SYSTEM, "code": self.version}
+
+
+def parse_month_day(value):
+    month, day = value.split("-")
+    return int(month), int(day)
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def load_schedule(path=DEFAULT_SCHEDULE_PATH):
+    with open(path, encoding="utf-8") as f:
+        return CompiledSchedule(json.load(f))
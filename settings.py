@@ -0,0 +1,46 @@
+import os
+
+FHIR_BASE_URL = os.environ.get("FHIR_BASE_URL", "https://hapi.fhir.org/baseR4")
+
+# Identifier shared by every resource this app creates on the FHIR server
+CDC_GROUP_IDENTIFIER_VALUE = "pnguyen332"
+
+SCHEDULE_CSV = os.environ.get("SCHEDULE_CSV", "schedule.csv")
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") != "0"
+
+# Columns of the reminder store (SCHEDULE_CSV)
+REMINDER_COLUMNS = [
+    "vaccine", "disease", "description", "recommended_date", "dose", "series", "cvx",
+    "patient_id", "email", "is_sent", "date_to_send", "recurring_until",
+]
+
+# Cache shared by the FHIR lookups: memory://, sqlite:///path/to/cache.db or redis://host:port/db
+CACHE_URL = os.environ.get("CACHE_URL", "memory://")
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Memory report in the sidebar (memory_accounting.py). It lists every session and can clear the shared cache,
+# so it is off unless an operator turns it on for a deployment.
+MEMORY_REPORT = os.environ.get("MEMORY_REPORT", "0") != "0"
+
+# Per-patient iCalendar feeds (calendar_feed.py): where they are written, the public URL they are served from
+# and the secret used to derive the unguessable feed names. The secret is required: without it no feed is published
+# or served, since anyone could compute a patient's feed name.
+CALENDAR_FEED_DIR = os.environ.get("CALENDAR_FEED_DIR", "calendar_feeds")
+CALENDAR_FEED_URL = os.environ.get("CALENDAR_FEED_URL", "http://localhost:8601")
+CALENDAR_FEED_SECRET = os.environ.get("CALENDAR_FEED_SECRET", "")
+
+# FHIR rest-hook Subscriptions (subscriptions.py). SUBSCRIPTION_ENDPOINT is the public URL the FHIR server posts
+# notifications to; setting it turns push invalidation on and raises the TTL of the invalidated caches.
+# SUBSCRIPTION_RECEIVER (host:port) starts the receiver inside the app process, which is needed with memory://.
+SUBSCRIPTION_ENDPOINT = os.environ.get("SUBSCRIPTION_ENDPOINT", "")
+SUBSCRIPTION_RECEIVER = os.environ.get("SUBSCRIPTION_RECEIVER", "")
+SUBSCRIPTION_SECRET = os.environ.get("SUBSCRIPTION_SECRET", "")
+SUBSCRIPTION_CACHE_TTL = int(os.environ.get("SUBSCRIPTION_CACHE_TTL", 24 * 60 * 60))
+
+# Seconds between incremental refreshes of the practitioner directory
+PRACTITIONER_DIRECTORY_MAX_AGE = int(os.environ.get("PRACTITIONER_DIRECTORY_MAX_AGE", 300))
+# Seconds between full reloads of the practitioner directory, which drop deleted practitioners
+PRACTITIONER_DIRECTORY_RELOAD_AGE = int(os.environ.get("PRACTITIONER_DIRECTORY_RELOAD_AGE", 6 * 60 * 60))
@@ -0,0 +1,207 @@
+"""
+Push-based cache invalidation through FHIR R4 rest-hook Subscriptions.
+
+The FHIR server notifies the receiver when a Patient, Observation or ImmunizationRecommendation changes, and the
+receiver drops only the cache entries tagged with that patient's compartment (see `compartment_tag`). When a
+notification does not say which patient is affected (empty payload, or the delete of a non-Patient resource),
+the namespaces caching that resource type are dropped instead.
+
+    python subscriptions.py register      # create/update the Subscriptions on settings.FHIR_BASE_URL
+    python subscriptions.py serve --port 8602
+
+With a shared cache (sqlite:// or redis://) one standalone receiver serves every replica; with memory:// set
+settings.SUBSCRIPTION_RECEIVER so each app process runs its own.
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from fhirpy import SyncFHIRClient
+
+import cache_backend
+import settings
+
+# Resource type -> search criteria of its Subscription
+SUBSCRIPTION_CRITERIA = {
+    "Patient": "Patient",
+    "Observation": f"Observation?identifier={settings.CDC_GROUP_IDENTIFIER_VALUE}",
+    "ImmunizationRecommendation": f"ImmunizationRecommendation?identifier={settings.CDC_GROUP_IDENTIFIER_VALUE}",
+}
+
+# Resource type -> cache namespaces dropped when the affected patient is unknown
+NAMESPACES = {
+    "Patient": ["patients", "recommendations"],
+    "Observation": ["observations"],
+    "ImmunizationRecommendation": ["recommendations", "immunization_schedules"],
+}
+
+
+def compartment_tag(patient_id, resource_type=None):
+    """
+    Cache tag of a patient's own resource ("Patient/123") or of its resources of one type ("Patient/123/Observation").
+    """
+    return f"Patient/{patient_id}" if resource_type is None else f"Patient/{patient_id}/{resource_type}"
+
+
+def patient_of(resource):
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    reference = (resource.get("patient") or resource.get("subject") or {}).get("reference", "")
+    return reference.split("/")[-1] if reference.startswith("Patient/") else None
+
+
+def invalidate(resource_type, resource_id=None, resource=None, backend=None):
+    """
+    Drop the cache entries affected by a change to one resource.
+
+    :return: the tags or namespaces that were invalidated
+    """
+    backend = backend or cache_backend.get_backend()
+    patient_id = patient_of(resource) if resource else (resource_id if resource_type == "Patient" else None)
+    if patient_id is None:
+        for namespace in NAMESPACES[resource_type]:
+            backend.invalidate(namespace)
+        return NAMESPACES[resource_type]
+
+    # The type tag covers searches that are not scoped to one patient, e.g. patient search by name
+    tags = [resource_type, compartment_tag(patient_id, None if resource_type == "Patient" else resource_type)]
+    for tag in tags:
+        backend.invalidate_tag(tag)
+    return tags
+
+
+def notified_resources(body):
+    """
+    Resources carried by a notification body: a single resource, or a Bundle of them.
+    """
+    if not body:
+        return []
+    if body.get("resourceType") == "Bundle":
+        return [entry["resource"] for entry in body.get("entry", []) if entry.get("resource")]
+    return [body]
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """
+    Accepts the requests a rest-hook channel sends: POST {endpoint} without a payload, and PUT/POST/DELETE
+    {endpoint}/{type}/{id} with the resource as payload.
+    """
+    backend = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.handle_notification()
+
+    def do_PUT(self):
+        self.handle_notification()
+
+    def do_DELETE(self):
+        self.handle_notification()
+
+    def handle_notification(self):
+        if settings.SUBSCRIPTION_SECRET and self.headers.get("Authorization") != f"Bearer {settings.SUBSCRIPTION_SECRET}":
+            return self.respond(401)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"null")
+        except ValueError:
+            return self.respond(400)
+
+        parts = [part for part in urlparse(self.path).path.split("/") if part]
+        resource_type, resource_id = None, None
+        if len(parts) >= 2 and parts[-2] in SUBSCRIPTION_CRITERIA:
+            resource_type, resource_id = parts[-2], parts[-1]
+        elif parts and parts[-1] in SUBSCRIPTION_CRITERIA:
+            resource_type = parts[-1]
+
+        resources = [resource for resource in notified_resources(body) if resource.get("resourceType") in SUBSCRIPTION_CRITERIA]
+        backend = self.backend or cache_backend.get_backend()
+        if self.command != "DELETE" and resources:
+            for resource in resources:
+                invalidate(resource["resourceType"], resource.get("id"), resource, backend)
+        elif resource_type:
+            invalidate(resource_type, resource_id, backend=backend)
+        else:
+            return self.respond(400)
+        self.respond(200)
+
+    def respond(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_receiver(host="127.0.0.1", port=0, backend=None):
+    """
+    Start the receiver in a background thread. Returns (server, url); call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), NotificationHandler)
+    server.RequestHandlerClass = type("BoundNotificationHandler", (NotificationHandler,), {"backend": backend})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def subscription_resource(resource_type, endpoint):
+    channel = {
+        "type": "rest-hook",
+        "endpoint": f"{endpoint.rstrip('/')}/{resource_type}",
+        "payload": "application/fhir+json",
+    }
+    if settings.SUBSCRIPTION_SECRET:
+        channel["header"] = [f"Authorization: Bearer {settings.SUBSCRIPTION_SECRET}"]
+    return {
+        "resourceType": "Subscription",
+        "status": "requested",
+        "reason": "Invalidate the cached FHIR lookups of the CDC Immunization Schedule Reminder",
+        "criteria": SUBSCRIPTION_CRITERIA[resource_type],
+        "channel": channel,
+    }
+
+
+def register(client, endpoint):
+    """
+    Create the Subscriptions, or update the ones already pointing to the endpoint.
+    """
+    subscriptions = []
+    for resource_type in SUBSCRIPTION_CRITERIA:
+        body = subscription_resource(resource_type, endpoint)
+        existing = client.resources("Subscription").search(url=body["channel"]["endpoint"]).first()
+        subscription = client.resource("Subscription", **{key: value for key, value in body.items() if key != "resourceType"})
+        if existing is not None:
+            subscription["id"] = existing["id"]
+        subscription.save()
+        subscriptions.append(subscription)
+    return subscriptions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register and receive FHIR Subscription notifications that invalidate the app caches.")
+    parser.add_argument("command", choices=["register", "serve"])
+    parser.add_argument("--endpoint", default=settings.SUBSCRIPTION_ENDPOINT, help="Public URL of the receiver")
+    parser.add_argument("--fhir-url", default=settings.FHIR_BASE_URL)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8602)
+    args = parser.parse_args()
+
+    if args.command == "register":
+        if not args.endpoint:
+            parser.error("Provide --endpoint or set SUBSCRIPTION_ENDPOINT")
+        for subscription in register(SyncFHIRClient(args.fhir_url), args.endpoint):
+            print(f"Subscription/{subscription['id']}: {subscription['criteria']} -> {subscription['channel']['endpoint']}")
+        return
+
+    server, url = start_receiver(args.host, args.port)
+    print(f"Receiving FHIR notifications on {url} (cache: {settings.CACHE_URL})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
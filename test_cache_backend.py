@@ -0,0 +1,44 @@
+import pickle
+
+import pytest
+
+import cache_backend
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def redis_backend(max_bytes):
+    return cache_backend.RedisCacheBackend(client=fakeredis.FakeRedis(), max_bytes=max_bytes)
+
+
+def test_redis_evicts_least_recently_used_past_max_bytes():
+    backend = redis_backend(max_bytes=3000)
+    for key in ("a", "b", "c"):
+        backend.set("patients", key, "x" * 900)
+    backend.get("patients", "a")
+    backend.set("patients", "d", "x" * 900)
+
+    assert backend.get("patients", "b") == (False, None)
+    assert [backend.get("patients", key)[0] for key in ("a", "c", "d")] == [True, True, True]
+    assert int(backend.client.get(backend.bytes_key)) <= 3000
+
+
+def test_redis_replacing_an_entry_does_not_count_it_twice():
+    backend = redis_backend(max_bytes=3000)
+    for _ in range(5):
+        backend.set("patients", "a", "x" * 900)
+
+    assert backend.stats()["patients"]["entries"] == 1
+    assert int(backend.client.get(backend.bytes_key)) == backend.stats()["patients"]["bytes"]
+
+
+def test_redis_stats_and_entries_skip_invalidated_entries():
+    backend = redis_backend(max_bytes=10_000)
+    backend.set("patients", "a", [1, 2, 3], tags=["Patient/1"])
+    backend.set("patients", "b", [4, 5])
+    backend.set("observations", "c", {"code": "8302-2"})
+    backend.invalidate("observations")
+    backend.invalidate_tag("Patient/1")
+
+    assert sorted((namespace, key) for namespace, key, _ in backend.entries()) == [("patients", "b")]
+    assert backend.stats() == {"patients": {"entries": 1, "bytes": len(pickle.dumps([4, 5], protocol=pickle.HIGHEST_PROTOCOL))}}
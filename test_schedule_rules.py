@@ -0,0 +1,90 @@
+from datetime import date, timedelta
+
+import schedule_rules
+
+DOB = date(2024, 1, 10)
+HIB = "49"
+PCV = "216"
+IPV = "10"
+HEP_B = "08"
+
+
+def planned_doses(cvx, history, dob=DOB, today=None):
+    """
+    Forecast as of `today`, by default the day after the last dose given.
+    """
+    today = today or (history[-1] + timedelta(days=1) if history else dob)
+    vaccine = schedule_rules.load_schedule().by_cvx[cvx]
+    return [(dose.dose, earliest) for dose, earliest, _ in vaccine.forecast(dob, history, today)]
+
+
+def test_hib_first_dose_at_13_months_makes_dose_2_final():
+    assert planned_doses(HIB, [date(2025, 2, 10)]) == [(2, date(2025, 4, 7))]
+
+
+def test_hib_second_dose_given_after_first_at_13_months_completes_series():
+    assert planned_doses(HIB, [date(2025, 2, 10), date(2025, 4, 10)]) == []
+
+
+def test_hib_first_dose_before_first_birthday_keeps_series():
+    assert [dose for dose, _ in planned_doses(HIB, [date(2024, 3, 10)])] == [2, 3, 4]
+
+
+def test_hib_first_dose_at_15_months_needs_no_further_dose():
+    assert planned_doses(HIB, [date(2025, 4, 10)]) == []
+
+
+def test_pcv_first_dose_at_13_months_makes_dose_2_final():
+    assert planned_doses(PCV, [date(2025, 2, 10)]) == [(2, date(2025, 4, 7))]
+
+
+def test_pcv_first_dose_at_20_months_makes_dose_2_final():
+    assert planned_doses(PCV, [date(2025, 9, 10)]) == [(2, date(2025, 11, 5))]
+
+
+def test_pcv_first_dose_before_first_birthday_keeps_series():
+    assert [dose for dose, _ in planned_doses(PCV, [date(2024, 3, 10)])] == [2, 3, 4]
+
+
+def test_overdue_dose_is_due_today_and_later_intervals_count_from_it():
+    today = date(2026, 3, 1)
+    assert planned_doses(HEP_B, [date(2020, 1, 10)], dob=date(2020, 1, 10), today=today) == [
+        (2, today), (3, date(2026, 4, 26)),
+    ]
+
+
+def test_combination_and_brand_codes_count_for_each_component_vaccine():
+    schedule = schedule_rules.load_schedule()
+    pediarix = [date(2024, 3, 10), date(2024, 5, 10)]
+    history = schedule.vaccine_history({"110": pediarix, "08": [date(2024, 1, 10)], "133": [date(2024, 3, 10)]})
+
+    assert history == {
+        "08": [date(2024, 1, 10), *pediarix],
+        "107": pediarix,
+        "10": pediarix,
+        "216": [date(2024, 3, 10)],
+    }
+
+
+def test_ipv_third_dose_is_final_for_a_child_of_4_or_older():
+    today = date(2026, 3, 1)
+    assert planned_doses(IPV, [date(2020, 3, 10), date(2020, 5, 10)], dob=date(2020, 1, 10), today=today) == [(3, today)]
+
+
+def test_ipv_third_dose_given_at_4_or_older_completes_series():
+    history = [date(2020, 3, 10), date(2020, 5, 10), date(2024, 3, 1)]
+    assert planned_doses(IPV, history, dob=date(2020, 1, 10)) == []
+
+
+def test_ipv_third_dose_given_before_4_keeps_fourth_dose():
+    history = [date(2020, 3, 10), date(2020, 5, 10), date(2020, 7, 10)]
+    assert planned_doses(IPV, history, dob=date(2020, 1, 10), today=date(2026, 3, 1)) == [(4, date(2026, 3, 1))]
+
+
+def test_hib_third_dose_is_final_after_first_birthday_when_first_two_were_early():
+    today = date(2025, 3, 1)
+    assert planned_doses(HIB, [date(2024, 3, 10), date(2024, 5, 10)], today=today) == [(3, today)]
+
+
+def test_hib_third_dose_after_first_dose_at_8_months_waits_for_first_birthday_as_final():
+    assert planned_doses(HIB, [date(2024, 9, 10), date(2024, 10, 10)]) == [(3, date(2025, 1, 10))]
@@ -7,17 +7,39 @@ import plotly.graph_objects as go
 from email.mime.text import MIMEText
 from fhirpy import SyncFHIRClient
 
+import cache_backend
+import fhir_read
+import practitioner_directory
+import schedule_rules
+import settings
+import subscriptions
 
-def get_fhir_client():
-    if 'client' not in st.session_state:
-        st.session_state.client = SyncFHIRClient('https://hapi.fhir.org/baseR4')
 
-    return st.session_state.client
+@st.cache_resource
+def get_fhir_client():
+    # The client only holds the base URL and settings, so one instance is shared by every session
+    return SyncFHIRClient(settings.FHIR_BASE_URL)
 
 
 client = get_fhir_client()
 
 
+@st.cache_resource
+def start_subscription_receiver():
+    # One receiver per app process; only needed when the cache is not shared with a standalone receiver
+    host, port = settings.SUBSCRIPTION_RECEIVER.rsplit(":", 1)
+    return subscriptions.start_receiver(host, int(port))[0]
+
+
+if settings.SUBSCRIPTION_RECEIVER:
+    start_subscription_receiver()
+
+
+@st.cache_resource
+def load_cdc_schedule():
+    return schedule_rules.load_schedule()
+
+
 # Function to calculate age from birthdate
 def calculate_age(birth_date_str, current_date):
     try:
@@ -28,7 +50,7 @@ def calculate_age(birth_date_str, current_date):
         return None
 
 
-@st.cache_data(ttl=60*60)
+@cache_backend.cached("patients", ttl=60*60, tags=lambda id=None, *_, **__: [subscriptions.compartment_tag(id)] if id else ["Patient"])
 def search_patient(id=None, first_name=None, last_name=None, dob: datetime = None):
     """
     Fetch all patients under 5 years old using FHIR search
@@ -45,13 +67,9 @@ def search_patient(id=None, first_name=None, last_name=None, dob: datetime = Non
         # patients_df = pd.read_csv('patients.csv')
         patients_df = pd.read_csv('patients_with_observation.csv')
         random_patients = patients_df.sample(n=10, random_state=1).values.flatten().tolist()
-        patients_list = []
-        for id in random_patients:
-            p = client.resources('Patient').search(**{"_id":id}).fetch()
-            for _p in p:
-                patients_list.append(_p.serialize())
-
-        return patients_list
+        # one search for all ten instead of one per patient, keeping the sampled order
+        patients = {p["id"]: p for p in fhir_read.search("Patient", {"_id": ",".join(random_patients)}, fhir_read.PATIENT_ELEMENTS)}
+        return [patients[id] for id in random_patients if id in patients]
     elif id is not None:
         params = {
             "_id": id
@@ -66,82 +84,29 @@ def search_patient(id=None, first_name=None, last_name=None, dob: datetime = Non
         st.error("Invalid parameters. Please provide either ID or First Name, Last Name, and DOB.")
         st.stop()
 
-    patients = client.resources('Patient').search(**params).fetch()
-    patients_list = [patient.serialize() for patient in patients]
-
-    return patients_list
-
-
-def display_calendar(events):
-    colors = ["#FF5733", "#33FF57", "#3357FF", "#FF33A1", "#A133FF", "#33FFF5", "#FF8C33", "#8CFF33", "#338CFF", "#FF338C"]
-    date_to_events = {}
-
-    for event in events:
-        event_date = event["start"].split("T")[0]
-        if event_date not in date_to_events:
-            date_to_events[event_date] = []
-        date_to_events[event_date].append(event)
-
-    for event_date, events_on_date in date_to_events.items():
-        for i, event in enumerate(events_on_date):
-            event["color"] = colors[i % len(colors)]
-            # start_date = event["start"].split("T")[0]
-            # end_date = event["end"].split("T")[0]
-            # if start_date != end_date:
-            #     event["classNames"] = ["event-range", "event-start", "event-end"]
-            # event["startClassNames"] = ["event-start"]
-            # event["endClassNames"] = ["event-end"]
-
-    options = {
-        # "editable": True,
-        "selectable": True,
-        # "headerToolbar": {
-        #     # "left": "prev,next",
-        #     # "center": "title",
-        #     # "right": "resourceTimelineDay,resourceTimelineWeek,resourceTimelineMonth",
-        # },
-        # "slotMinTime": "06:00:00",
-        # "slotMaxTime": "18:00:00",
-        "initialView": "multiMonthYear",
-        # "dayMaxEventRows": 3,
-        # "size": "1000x300",
-        "height": "550px",
-        # "months": 4,
-    }
-
-    custom_css = """
-        .fc-event-past {
-            opacity: 0.8;
-        }
-        .fc-event-time {
-            font-style: italic;
-        }
-        .fc-event-title {
-            font-weight: 700;
-        }
-        .fc-toolbar-title {
-            font-size: 2rem;
-        }
-    """
-
-    cld = calendar(
-        events=events,
-        options=options,
-        custom_css=custom_css,
-        key='calendar',  # Assign a widget key to prevent state loss
-    )
+    return fhir_read.search_all('Patient', params, fhir_read.PATIENT_ELEMENTS)
 
-    st.write(cld)
 
-
-def send_email(to_email, vaccine_name, date_to_get, dose):
+def open_smtp_connection():
     brevo_info = st.secrets["email"]
     SENDER = brevo_info["SENDER"]
     PWD = brevo_info["PWD"]
-    SENDER_EMAIL = brevo_info["SENDER_EMAIL"]
-    SENDER_PASSWORD = brevo_info["SENDER_PASSWORD"]
-    SMTP_SERVER = brevo_info["SMTP_SERVER"]
-    SMTP_PORT = brevo_info["SMTP_PORT"]
+    server = smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT)
+    if settings.SMTP_STARTTLS:
+        server.starttls()
+    server.login(SENDER, PWD)
+    return server
+
+
+def build_message(to_email, subject, body):
+    msg = MIMEText(body)
+    msg["Subject"] = subject
+    msg["From"] = st.secrets["email"]["SENDER"]
+    msg["To"] = to_email
+    return msg
+
+
+def build_reminder_message(to_email, vaccine_name, date_to_get, dose):
     subject = f"Upcoming Immunization Reminder: {vaccine_name}"
     body = f"""
     Dear User,
@@ -153,17 +118,33 @@ def send_email(to_email, vaccine_name, date_to_get, dose):
 
     Please schedule your appointment if you haven’t already.
     """
+    return build_message(to_email, subject, body)
 
-    msg = MIMEText(body)
-    msg["Subject"] = subject
-    msg["From"] = SENDER
-    msg["To"] = to_email
 
+def build_digest_message(to_email, entries):
+    """
+    One message listing every reminder due for a recipient, instead of one message per dose.
+    """
+    vaccines = "\n".join(
+        f"    - {entry['vaccine']} (Dose: {entry['dose']}): {entry['recommended_date']}"
+        for _, entry in entries.sort_values("recommended_date").iterrows()
+    )
+    subject = f"Upcoming Immunization Reminder: {len(entries)} vaccine{'s' if len(entries) > 1 else ''} due"
+    body = f"""
+    Dear User,
+
+    This is a reminder for your upcoming immunizations:
+{vaccines}
+
+    Please schedule your appointment if you haven’t already.
+    """
+    return build_message(to_email, subject, body)
+
+
+def send_email(to_email, vaccine_name, date_to_get, dose):
     try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(SENDER, PWD)
-            server.send_message(msg)
+        with open_smtp_connection() as server:
+            server.send_message(build_reminder_message(to_email, vaccine_name, date_to_get, dose))
         return True
     except Exception as e:
         return str(e)
@@ -171,9 +152,9 @@ def send_email(to_email, vaccine_name, date_to_get, dose):
 
 def write_schedule_to_csv(df):
     try:
-        current_schedule = pd.read_csv("schedule.csv", header=0)
+        current_schedule = pd.read_csv(settings.SCHEDULE_CSV, header=0, dtype={"cvx": str})
     except pd.errors.EmptyDataError:
-        df.to_csv("schedule.csv", index=False)
+        df.to_csv(settings.SCHEDULE_CSV, index=False)
         return
 
     if current_schedule.shape[0] > 0:
@@ -182,72 +163,118 @@ def write_schedule_to_csv(df):
         if new_email in current_schedule['email'].values:
             current_schedule = current_schedule[current_schedule['email'] != new_email]
         df = pd.concat([current_schedule, df], ignore_index=True)
-    df.to_csv("schedule.csv", index=False, header=True)
+    df.to_csv(settings.SCHEDULE_CSV, index=False, header=True)
+
+
+def next_recurring_reminder(entry, schedule):
+    """
+    Materialize the reminder for the season following a recurring reminder row, or for the current season when the
+    row is older than that; None if the vaccine is not recurring or the next season is past the row's horizon.
+    """
+    if pd.isna(entry.get("recurring_until")) or pd.isna(entry.get("cvx")):
+        return None
+    vaccine = schedule.by_cvx.get(str(entry["cvx"]))
+    if vaccine is None or vaccine.recurring is None:
+        return None
+
+    first_day_to_get = datetime.strptime(entry["recommended_date"].split(" - ")[0], "%Y/%m/%d").date()
+    days_ahead = first_day_to_get - datetime.strptime(entry["date_to_send"], "%Y/%m/%d").date()
+    until = datetime.strptime(entry["recurring_until"], "%Y/%m/%d").date()
+    season = next(vaccine.recurring.seasons(first_day_to_get, until, datetime.now().date()), None)
+    if season is None:
+        return None
+
+    start, end = season
+    next_entry = entry.copy()
+    next_entry["recommended_date"] = f"{start.strftime('%Y/%m/%d')} - {end.strftime('%Y/%m/%d')}"
+    next_entry["is_sent"] = False
+    next_entry["date_to_send"] = (start - days_ahead).strftime("%Y/%m/%d")
+    return next_entry
 
 
 # Run every 3 hours
 @st.fragment(run_every=10800)
-def check_and_send_email():
-    df = pd.read_csv("schedule.csv", header=0)
-    df = df[df["is_sent"] == False]
+def check_and_send_email(digest=True):
+    """
+    Send the reminders that are due. In digest mode every recipient gets a single message listing all of
+    their due vaccines; otherwise one message is sent per dose. All messages share one SMTP session.
+    """
+    df = pd.read_csv(settings.SCHEDULE_CSV, header=0, dtype={"cvx": str})
+    schedule = load_cdc_schedule()
     current_date = datetime.now().date()
-    for idx, entry in df.iterrows():
-        dose = entry["dose"]
-        vaccine_name = entry["vaccine"]
-        notification_date = entry["date_to_send"]
-        notification_date = datetime.strptime(notification_date, "%Y/%m/%d").date()
-        email = entry["email"]
-
-        # st.write(f"- **{vaccine_name}**: {date_to_get} (Dose: {dose})")
-        # st.write(f"  Notification date: {notification_date}")
-
-        # Check if today is the notification date
-        if current_date >= notification_date and not entry["is_sent"]:
-            result = send_email(email, vaccine_name, entry["date_to_send"], dose)
-            if result is True:
-                df.loc[idx, "is_sent"] = True
-                df.to_csv("schedule.csv", index=False, header=True)
-                st.success(f"Reminder email sent to {email} for {vaccine_name}!")
-                # st.stop()
-            else:
-                st.error(f"Failed to send email: {result}")
-        #     if result is True:
-        #         st.success(f"Reminder email sent to {email} for {vaccine_name}!")
-        #     else:
-        #         st.error(f"Failed to send email: {result}")
-        # elif current_date < notification_date:
-        #     st.write(f"  Reminder will be available on {notification_date}")
-        # else:
-        #     st.write(f"  Notification date has passed")
-
-
-@st.cache_data(ttl=600)
-def search_practitioner(id=None):
+    notification_dates = pd.to_datetime(df["date_to_send"], format="%Y/%m/%d").dt.date
+    due = df[(df["is_sent"] == False) & (notification_dates <= current_date)]
+    if due.empty:
+        return
+
+    if digest:
+        batches = [(email, entries) for email, entries in due.groupby("email", sort=False)]
+    else:
+        batches = [(entry["email"], due.loc[[idx]]) for idx, entry in due.iterrows()]
+
+    next_entries = []
+    try:
+        with open_smtp_connection() as server:
+            for email, entries in batches:
+                if digest:
+                    msg = build_digest_message(email, entries)
+                else:
+                    entry = entries.iloc[0]
+                    msg = build_reminder_message(email, entry["vaccine"], entry["recommended_date"], entry["dose"])
+                try:
+                    server.send_message(msg)
+                except Exception as e:
+                    # e.g. a refused address: leave these unsent and go on with the other recipients
+                    st.error(f"Failed to send email to {email}: {str(e)}")
+                    continue
+                df.loc[entries.index, "is_sent"] = True
+                for _, entry in entries.iterrows():
+                    # Keep recurring doses one season ahead instead of storing every season up front
+                    next_entry = next_recurring_reminder(entry, schedule)
+                    if next_entry is not None:
+                        next_entries.append(next_entry)
+                st.success(f"Reminder email sent to {email} for {', '.join(entries['vaccine'])}!")
+    except Exception as e:
+        st.error(f"Failed to send email: {str(e)}")
+    finally:
+        if next_entries:
+            df = pd.concat([df, pd.DataFrame(next_entries)], ignore_index=True)
+        df.to_csv(settings.SCHEDULE_CSV, index=False, header=True)
+
+
+@cache_backend.cached("practitioners", ttl=600)
+def search_practitioner(id):
     """
-    Search for practitioners by name or identifier.
+    Look up a practitioner on the server, for ids not in the directory yet.
 
-    :param _id: The id of the practitioner.
+    :param id: The id of the practitioner.
     """
-    search_params = {}
-    if id:
-        search_params['_id'] = id
+    practitioners = client.resources('Practitioner').search(_id=id).elements("id").fetch()
+    return [practitioner['id'] for practitioner in practitioners]
 
-    practitioners = client.resources('Practitioner').search(**search_params).limit(10).fetch()
-    if practitioners:
-        practitioner_ids = [practitioner['id'] for practitioner in practitioners]
-        return practitioner_ids
-    return []
+
+@st.cache_resource
+def get_practitioner_directory():
+    # Shared by every session of the process and refreshed incrementally
+    return practitioner_directory.PractitionerDirectory(client)
 
 
 def read_schedule_from_csv():
     try:
-        return pd.read_csv("schedule.csv", header=0)
+        return pd.read_csv(settings.SCHEDULE_CSV, header=0, dtype={"cvx": str})
     except pd.errors.EmptyDataError:
         return None
     except FileNotFoundError:
         return None
 
 
+def render_schedule_table(model):
+    st.dataframe(model.to_dataframe(), hide_index=True, column_config={
+        "recommended_from": st.column_config.DateColumn("recommended_from", format="YYYY/MM/DD"),
+        "recommended_to": st.column_config.DateColumn("recommended_to", format="YYYY/MM/DD"),
+    })
+
+
 def render_search_patient_form():
     patient = None
     patient_l, patient_r = st.columns([0.5, 3.5])
@@ -295,6 +322,7 @@ def render_search_patient_form():
 
 def render_search_practitioner_form():
     st.session_state['practitioner_id'] = None if 'practitioner_id' not in st.session_state else st.session_state['practitioner_id']
+    directory = get_practitioner_directory()
     pract_l, pract_r = st.columns([0.5, 3.5])
     with pract_l:
         has_practitioner_id = st.radio("Do you have a Practitioner ID?", ["Yes", "No"], index=0, horizontal=True)
@@ -305,22 +333,31 @@ def render_search_practitioner_form():
                 submit_practitioner = st.form_submit_button("Search Practitioner")
                 if submit_practitioner:
                     if practitioner_id_input:
-                        practitioner_id = search_practitioner(practitioner_id_input)
-                        st.session_state['practitioner_id'] = practitioner_id[0]
-                        if not practitioner_id:
+                        if directory.get(practitioner_id_input) is None and not search_practitioner(practitioner_id_input):
                             st.error("No Practitioner found with the given ID.")
                             st.stop()
+                        st.session_state['practitioner_id'] = practitioner_id_input
                     else:
                         st.error("Please enter a Practitioner ID.")
                         st.stop()
         else:
-            practitioner_ids = search_practitioner()
-            practitioner_id = st.selectbox("Select Practitioner ID (for testing purpose)", practitioner_ids, key="practitioner_id_select")
+            # Only browsing needs the whole directory; an ID is checked with one search when it is not loaded yet
+            directory.refresh_if_stale(settings.PRACTITIONER_DIRECTORY_MAX_AGE, settings.PRACTITIONER_DIRECTORY_RELOAD_AGE)
+            query = st.text_input("Search Practitioner by name, ID or identifier", key="practitioner_query")
+            matches = directory.count_patients(directory.search(query))
+            labels = {entry.id: entry.label() for entry in matches}
+            practitioner_id = st.selectbox("Select Practitioner", list(labels), format_func=labels.get, key="practitioner_id_select")
+            st.caption(f"{len(directory)} practitioners in the directory")
             st.session_state['practitioner_id'] = practitioner_id
 
 
-def render_health_record_charts(patient_id):
-    observations = client.resources('Observation').search(patient=f'Patient/{patient_id}', identifier='pnguyen332').fetch_all()
+@cache_backend.cached("observations", ttl=600, tags=lambda patient_id: [subscriptions.compartment_tag(patient_id, "Observation")])
+def fetch_health_records(patient_id):
+    observations = fhir_read.search(
+        'Observation',
+        {"patient": f'Patient/{patient_id}', "identifier": settings.CDC_GROUP_IDENTIFIER_VALUE},
+        fhir_read.OBSERVATION_ELEMENTS,
+    )
     heights = {'date': [], 'value': [], 'unit': []}
     weights = {'date': [], 'value': [], 'unit': []}
     heart_rates = {'date': [], 'value': [], 'unit': []}
@@ -329,32 +366,33 @@ def render_health_record_charts(patient_id):
     bmi = {'date': [], 'value': [], 'unit': []}
 
     for obs in observations:
-        if obs.code.coding[0].code == "8302-2":
-            heights['value'].append(obs.valueQuantity.value)
-            heights['date'].append(obs.effectiveDateTime)
-            heights['unit'].append(obs.valueQuantity.unit)
-        elif obs.code.coding[0].code == "29463-7":
-            weights['date'].append(obs.effectiveDateTime)
-            weights['value'].append(obs.valueQuantity.value)
-            weights['unit'].append(obs.valueQuantity.unit)
-        elif obs.code.coding[0].code == "8867-4":
-            heart_rates['date'].append(obs.effectiveDateTime)
-            heart_rates['value'].append(obs.valueQuantity.value)
-            heart_rates['unit'].append(obs.valueQuantity.unit)
-        elif obs.code.coding[0].code == "85354-9":
-            for _obs in obs.component:
-                if _obs.code.coding[0].code == "8480-6":
-                    systolic['value'].append(_obs.valueQuantity.value)
-                    systolic['date'].append(obs.effectiveDateTime)
-                    systolic['unit'].append(_obs.valueQuantity.unit)
-                elif _obs.code.coding[0].code == "8462-4":
-                    diastolic['value'].append(_obs.valueQuantity.value)
-                    diastolic['date'].append(obs.effectiveDateTime)
-                    diastolic['unit'].append(_obs.valueQuantity.unit)
-        elif obs.code.coding[0].code == "39156-5":
-            bmi['value'].append(obs.valueQuantity.value)
-            bmi['date'].append(obs.effectiveDateTime)
-            bmi['unit'].append(obs.valueQuantity.unit)
+        code = obs["code"]["coding"][0]["code"]
+        if code == "8302-2":
+            heights['value'].append(obs["valueQuantity"]["value"])
+            heights['date'].append(obs["effectiveDateTime"])
+            heights['unit'].append(obs["valueQuantity"]["unit"])
+        elif code == "29463-7":
+            weights['date'].append(obs["effectiveDateTime"])
+            weights['value'].append(obs["valueQuantity"]["value"])
+            weights['unit'].append(obs["valueQuantity"]["unit"])
+        elif code == "8867-4":
+            heart_rates['date'].append(obs["effectiveDateTime"])
+            heart_rates['value'].append(obs["valueQuantity"]["value"])
+            heart_rates['unit'].append(obs["valueQuantity"]["unit"])
+        elif code == "85354-9":
+            for _obs in obs.get("component", []):
+                if _obs["code"]["coding"][0]["code"] == "8480-6":
+                    systolic['value'].append(_obs["valueQuantity"]["value"])
+                    systolic['date'].append(obs["effectiveDateTime"])
+                    systolic['unit'].append(_obs["valueQuantity"]["unit"])
+                elif _obs["code"]["coding"][0]["code"] == "8462-4":
+                    diastolic['value'].append(_obs["valueQuantity"]["value"])
+                    diastolic['date'].append(obs["effectiveDateTime"])
+                    diastolic['unit'].append(_obs["valueQuantity"]["unit"])
+        elif code == "39156-5":
+            bmi['value'].append(obs["valueQuantity"]["value"])
+            bmi['date'].append(obs["effectiveDateTime"])
+            bmi['unit'].append(obs["valueQuantity"]["unit"])
         else:
             continue
 
@@ -367,6 +405,11 @@ def render_health_record_charts(patient_id):
         'diastolic': diastolic,
         'bmi': bmi
     }
+    return data
+
+
+def render_health_record_charts(patient_id):
+    data = fetch_health_records(patient_id)
 
     col1, col2 = st.columns(2)
 